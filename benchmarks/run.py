@@ -0,0 +1,215 @@
+"""Benchmarks for toyblock.
+
+Run from the project's root::
+
+    python benchmarks/run.py --output before.json
+    # change something
+    python benchmarks/run.py --output after.json --compare before.json
+
+Every scenario is measured as the time of one frame. The median and the
+minimum of all the frames are written as JSON, so results of different
+commits can be compared.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import toyblock
+
+SIZES = (1000, 10000, 100000)
+CHURNS = (0.1, 0.5)
+SYSTEMS = (1, 5, 20)
+COMPONENTS = (1, 8, 32)
+
+def make_types(n):
+    """Return *n* distinct component classes."""
+    return tuple(type("Component{}".format(i), (object,), {"__init__": _init})
+                 for i in range(n))
+
+def _init(self):
+    self.value = 0
+
+def measure(frame, frames):
+    times = []
+    for i in range(frames):
+        start = perf_counter()
+        frame()
+        times.append(perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times)}
+
+def pool_churn(size, churn, frames, batch=False):
+    """Free and get back *churn* of a full pool every frame."""
+    pool = toyblock.Pool(size, make_types(2))
+    used = pool.get_many(size)
+    n = int(size*churn)
+
+    def frame():
+        if batch:
+            pool.free_many(used[:n])
+            used[:n] = pool.get_many(n)
+            return
+        for i in range(n):
+            used[i].free()
+        for i in range(n):
+            used[i] = pool.get()
+
+    return measure(frame, frames)
+
+def pool_get_free(size, frames):
+    """Get every entity of a pool with one system one by one, then free
+    them one by one.
+    """
+    system = toyblock.System(lambda system, entity: None)
+    pool = toyblock.Pool(size, make_types(2), systems=(system,))
+
+    def frame():
+        used = [pool.get() for i in range(size)]
+        for entity in used:
+            entity.free()
+
+    return measure(frame, frames)
+
+def entity_create(size, frames):
+    """Create *size* entities with two components outside of a pool."""
+    types = make_types(2)
+
+    def frame():
+        [toyblock.Entity(*[type_() for type_ in types]) for i in range(size)]
+
+    return measure(frame, frames)
+
+def system_iteration(size, churn, systems, frames):
+    """Run *systems* systems over a pool, freeing and getting back *churn*
+    of the entities from inside the first system.
+    """
+    types = make_types(2)
+    first = types[0]
+    n = int(size*churn)
+
+    def step(system, entity):
+        entity[first].value += 1
+
+    def life(system, entity, dead):
+        if len(dead) < n:
+            dead.append(entity)
+            entity.free()
+
+    all_systems = [toyblock.System(life)]
+    all_systems += [toyblock.System(step) for i in range(systems - 1)]
+    pool = toyblock.Pool(size, types, systems=all_systems)
+    pool.get_many(size)
+
+    def frame():
+        dead = []
+        all_systems[0](dead)
+        for system in all_systems[1:]:
+            system()
+        pool.get_many(len(dead))
+
+    return measure(frame, frames)
+
+def component_access(size, components, frames):
+    """Read the last component of every entity of a pool."""
+    types = make_types(components)
+    last = types[-1]
+    pool = toyblock.Pool(size, types)
+    used = pool.get_many(size)
+
+    def frame():
+        for entity in used:
+            entity[last].value
+
+    return measure(frame, frames)
+
+def scenarios(args):
+    for size, churn in itertools.product(args.sizes, args.churns):
+        params = {"size": size, "churn": churn}
+        yield ("pool_churn", params,
+               lambda size=size, churn=churn:
+                   pool_churn(size, churn, args.frames))
+        yield ("pool_churn_batch", params,
+               lambda size=size, churn=churn:
+                   pool_churn(size, churn, args.frames, batch=True))
+    for size in args.sizes:
+        params = {"size": size}
+        yield ("pool_get_free", params,
+               lambda size=size: pool_get_free(size, args.frames))
+        yield ("entity_create", params,
+               lambda size=size: entity_create(size, args.frames))
+    for size, churn, systems in itertools.product(args.sizes, args.churns,
+                                                  args.systems):
+        params = {"size": size, "churn": churn, "systems": systems}
+        yield ("system_iteration", params,
+               lambda size=size, churn=churn, systems=systems:
+                   system_iteration(size, churn, systems, args.frames))
+    for size, components in itertools.product(args.sizes, args.components):
+        params = {"size": size, "components": components}
+        yield ("component_access", params,
+               lambda size=size, components=components:
+                   component_access(size, components, args.frames))
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ("git", "rev-parse", "--short", "HEAD"),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--churns", type=float, nargs="+", default=CHURNS)
+    parser.add_argument("--systems", type=int, nargs="+", default=SYSTEMS)
+    parser.add_argument("--components", type=int, nargs="+", default=COMPONENTS)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--filter", default="",
+                        help="Only run scenarios whose name contains this")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as file_:
+            previous = {key(result): result
+                        for result in json.load(file_)["results"]}
+
+    results = []
+    for name, params, run in scenarios(args):
+        if args.filter not in name:
+            continue
+        result = dict(name=name, params=params, **run())
+        results.append(result)
+        line = "{:<20} {:<50} {:>10.3f} ms".format(
+            name, json.dumps(params, sort_keys=True), result["median"]*1000.)
+        old = previous.get(key(result))
+        if old is not None:
+            line += "  x{:.2f}".format(result["median"]/old["median"])
+        print(line)
+
+    if args.output:
+        report = {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "frames": args.frames,
+            "results": results,
+        }
+        with open(args.output, "w") as file_:
+            json.dump(report, file_, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
+import asyncio
+import gc
+import os
+import tempfile
+import threading
+import time
 import unittest
 import toyblock
 from toyblock import Entity, Pool, System
+from toyblock.spatial import SpatialGrid
+from toyblock.shared import SharedPool, ShardedSystem
+from toyblock.hierarchy import Hierarchy
 
 class A(object):
     def __init__(self):
@@ -19,6 +28,22 @@ class D(object):
         self.v = v
         self.d = d
 
+class Particle(object):
+    columns = {'x': 'd', 'life': 'i'}
+    def __init__(self):
+        self.x = 0.
+        self.life = 2
+
+def _age(shard, dx):
+    xs = shard.column(Particle, 'x')
+    lifes = shard.column(Particle, 'life')
+    for i in shard.slots:
+        xs[i] += dx
+        lifes[i] -= 1
+        if not lifes[i]:
+            shard.free(i)
+            shard.spawn(xs[i])
+
 class PoolTest(unittest.TestCase):
     def test1_get(self):
         unique = Pool(2, (A,))
@@ -123,6 +148,21 @@ class PoolTest(unittest.TestCase):
         accu = entity[Accumulator]
         self.assertEqual(accu.step, 3)
 
+    def test11_free_keeps_order(self):
+        @System
+        def system(system, entity):
+            pass
+
+        pool = toyblock.Pool(5, (A,), systems=(system,))
+        entities = [pool.get() for i in range(5)]
+        entities[1].free()
+        entities[3].free()
+        entities[3].free()
+        self.assertEqual(list(system.entities),
+                         [entities[0], entities[2], entities[4]])
+        self.assertEqual(list(pool._used), list(system.entities))
+        self.assertFalse(system in entities[1])
+
     def test10_free_all(self):
         class Times:
             times = 0
@@ -137,6 +177,245 @@ class PoolTest(unittest.TestCase):
         pool.free_all()
         self.assertEqual(Times.times, 10)
 
+    def test12_get_many_free_many(self):
+        inits = []
+        cleans = []
+
+        @System
+        def system(system, entity):
+            pass
+
+        pool = toyblock.Pool(10, (A,), systems=(system,))
+        pool.init(inits.append)
+        pool.clean(cleans.append)
+        entities = pool.get_many(4)
+        self.assertEqual(len(entities), 4)
+        self.assertEqual(inits, entities)
+        self.assertEqual(list(system.entities), entities)
+        self.assertEqual(len(pool.get_many(20)), 6)
+        self.assertEqual(pool.get_many(1), [])
+        pool.free_many(entities[:2] + entities[:1])
+        self.assertEqual(cleans, entities[:2])
+        self.assertEqual(len(system), 8)
+        self.assertFalse(system in entities[0])
+        pool.free_all()
+        self.assertEqual(len(system), 0)
+        self.assertEqual(len(pool.get_many(10)), 10)
+
+    def test13_free_many_inside_system(self):
+        @System
+        def system(system, entity, pool):
+            pool.free_many((entity,))
+
+        pool = toyblock.Pool(3, (A,), systems=(system,))
+        pool.get_many(3)
+        system(pool)
+        self.assertEqual(len(system), 0)
+        self.assertEqual(len(pool.get_many(3)), 3)
+
+    def test14_columnar(self):
+        class Body(object):
+            columns = {'x': 'd', 'y': 'd'}
+            def __init__(self, y=0.):
+                self.x = 1.
+                self.y = y
+            def length(self):
+                return self.x + self.y
+
+        pool = toyblock.Pool(4, (Body, A), ((), ()), ({'y': 2.},),
+                             columnar=True)
+        entity = pool.get()
+        body = entity[Body]
+        self.assertEqual((body.x, body.y), (1., 2.))
+        entity.set(Body, {'x': 5.})
+        body.y += 1.
+        xs = pool.column(Body, 'x')
+        self.assertEqual(len(xs), 4)
+        self.assertEqual(xs[entity.slot], 5.)
+        self.assertEqual(pool.column(Body, 'y')[entity.slot], 3.)
+        self.assertEqual(body.length(), 8.)
+
+        class Named(Body):
+            def __init__(self):
+                Body.__init__(self)
+                self.name = "body"
+
+        self.assertRaises(ValueError, toyblock.Pool, 1, (Named,),
+                          columnar=True)
+        self.assertEqual(entity[A].a, 0)
+        self.assertRaises(KeyError, pool.column, A, 'a')
+        plain = toyblock.Pool(1, (Body,))
+        self.assertTrue(isinstance(plain.get()[Body], Body))
+
+    def test15_growth(self):
+        resizes = []
+        pool = toyblock.Pool(2, (A,), growth="double", max_size=5,
+                             shrink_after=2)
+        pool.resize(lambda pool, old, new: resizes.append((old, new)))
+        entities = pool.get_many(3)
+        self.assertEqual(len(entities), 3)
+        self.assertEqual(pool.capacity, 4)
+        entities += [pool.get(), pool.get()]
+        self.assertEqual(pool.get(), None)
+        self.assertEqual(pool.capacity, 5)
+        self.assertEqual(resizes, [(2, 4), (4, 5)])
+        self.assertEqual(sorted(entity.slot for entity in entities),
+                         [0, 1, 2, 3, 4])
+        pool.free_many(entities[2:])
+        pool.tick()
+        pool.tick()
+        self.assertEqual(pool.capacity, 5)
+        pool.tick()
+        pool.tick()
+        self.assertEqual(pool.capacity, 2)
+        self.assertEqual(resizes[-1], (5, 2))
+        self.assertEqual(pool.get().slot, 2)
+        self.assertEqual(pool.capacity, 4)
+
+    def test16_growth_step_columnar(self):
+        class Body(object):
+            columns = {'x': 'd'}
+            def __init__(self):
+                self.x = 3.
+
+        pool = toyblock.Pool(1, (Body,), columnar=True, growth=2)
+        entities = pool.get_many(2)
+        self.assertEqual(pool.capacity, 3)
+        self.assertEqual(pool.column(Body, 'x').tolist(), [3.]*3)
+        entities[1][Body].x = 1.
+        self.assertEqual(pool.column(Body, 'x')[entities[1].slot], 1.)
+        self.assertRaises(ValueError, toyblock.Pool, 1, (A,), growth=0)
+
+    def test17_lazy(self):
+        class Heavy(object):
+            built = 0
+            def __init__(self):
+                Heavy.built += 1
+
+        pool = toyblock.Pool(10, (Heavy,), lazy=True)
+        self.assertEqual((Heavy.built, pool.built, pool.capacity), (0, 0, 10))
+        entity = pool.get()
+        self.assertEqual((Heavy.built, entity.slot), (1, 0))
+        self.assertEqual(pool.prewarm(3), 3)
+        self.assertEqual(pool.get().slot, 1)
+        self.assertEqual(pool.prewarm_step(1000.), 0)
+        self.assertEqual(Heavy.built, 10)
+        self.assertEqual(pool.prewarm(), 0)
+        self.assertEqual(len(pool.get_many(20)), 8)
+        self.assertEqual(Heavy.built, 10)
+
+    def test18_lazy_growth(self):
+        pool = toyblock.Pool(2, (A,), lazy=True, growth=4)
+        self.assertEqual(len(pool.get_many(3)), 3)
+        self.assertEqual((pool.built, pool.capacity), (3, 6))
+
+    def test19_handles(self):
+        pool = toyblock.Pool(2, (A,), growth=2, shrink_after=1)
+        entity = pool.get()
+        handle = pool.handle(entity)
+        self.assertTrue(pool.resolve(handle) is entity)
+        entity.free()
+        self.assertFalse(pool.is_valid(handle))
+        self.assertRaises(ValueError, pool.handle, entity)
+        reused = pool.get()
+        self.assertTrue(reused is entity)
+        self.assertTrue(pool.resolve(handle) is None)
+        self.assertTrue(pool.is_valid(pool.handle(reused)))
+        self.assertTrue(pool.resolve(1 << 32 | 5) is None)
+        grown = pool.get_many(3)
+        last = pool.handle(grown[-1])
+        pool.free_many(grown)
+        pool.tick()
+        pool.get_many(3)
+        self.assertFalse(pool.is_valid(last))
+
+    def test20_reset(self):
+        class Body(object):
+            columns = {'x': 'd'}
+            def __init__(self):
+                self.x = 1.
+
+        texture = object()
+
+        class Inventory(object):
+            reset_copy = ('items',)
+            def __init__(self, name):
+                self.name = name
+                self.items = []
+                self.texture = texture
+                self.lock = threading.Lock()
+
+        class Slotted(object):
+            __slots__ = ('life', 'target')
+            def __init__(self):
+                self.life = 3
+
+        pool = toyblock.Pool(6, (Body, Inventory, Slotted), (None, ("bag",)),
+                             columnar=True, reset=True)
+        cleaned = []
+
+        @pool.clean
+        def clean(entity):
+            cleaned.append(entity[Inventory].items[:])
+
+        entities = pool.get_many(6)
+        for entity in entities:
+            entity[Body].x = 5.
+            entity[Inventory].items.append("sword")
+            entity[Inventory].name = "chest"
+            entity[Slotted].life = 0
+            entity[Slotted].target = entity
+        entities[5].free()
+        pool.free_many([entities[0], entities[1], entities[3]])
+        self.assertEqual(cleaned, [["sword"]]*4)
+        self.assertEqual(list(pool.column(Body, 'x')), [1., 1., 5., 1., 5., 1.])
+        for entity in (entities[0], entities[5]):
+            self.assertEqual(entity[Inventory].items, [])
+            self.assertEqual(entity[Inventory].name, "bag")
+            self.assertEqual(entity[Slotted].life, 3)
+            self.assertFalse(hasattr(entity[Slotted], 'target'))
+            self.assertTrue(entity[Inventory].texture is texture)
+        self.assertFalse(entities[0][Inventory].items
+                         is entities[5][Inventory].items)
+        self.assertEqual(entities[2][Inventory].items, ["sword"])
+
+        @pool.clean
+        def broken(entity):
+            raise RuntimeError("broken")
+
+        self.assertRaises(RuntimeError, entities[2].free)
+        self.assertRaises(RuntimeError, pool.free_many, entities[3:5])
+        self.assertEqual(list(pool._used), [entities[2], entities[4]])
+        self.assertEqual(len(pool._avaliable), 4)
+
+    def test21_memory_report(self):
+        class Inventory(object):
+            def __init__(self):
+                self.items = [0]*100
+
+        class Body(object):
+            columns = {'x': 'd'}
+            def __init__(self):
+                self.x = 0.
+
+        pool = toyblock.Pool(10, (Inventory, Body), columnar=True)
+        system = System(lambda system, entity: None, requires=(Inventory,))
+        pool.get_many(4)
+        report = pool.memory_report()
+        self.assertTrue(report["components"][Inventory] > 10*100*8)
+        self.assertTrue(report["components"][Body] > 10*8)
+        self.assertEqual(report["total"], sum(report["components"].values())
+                         + report["entities"] + report["bookkeeping"])
+        self.assertEqual((report["built"], report["used"], report["peak_used"]),
+                         (10, 4, 4))
+        pool.free_all()
+        self.assertEqual(pool.memory_report()["peak_used"], 4)
+        self.assertEqual(system.memory_report()["entities"], 0)
+        everything = toyblock.memory_report()
+        self.assertEqual(everything["pools"][pool]["used"], 0)
+        self.assertTrue(system in everything["systems"])
+        self.assertTrue(everything["total"] >= report["total"])
+
 class EntityTest(unittest.TestCase):
     def setUp(self):
         self.a = A()
@@ -176,6 +455,39 @@ class EntityTest(unittest.TestCase):
         self.assertEqual(g.b, 2)
         self.assertEqual(g.c, 3)
 
+    def test6_tags(self):
+        class Enemy(object):
+            pass
+
+        class Red(object):
+            pass
+
+        class Brain(object):
+            pass
+
+        red = System(lambda system, entity: None, requires=(Enemy, Red))
+        pool = Pool(3, (Enemy, Brain))
+        first, second = pool.get_many(2)
+        self.assertRaises(toyblock.EntityError, pool._entities[2].add_tag, Red)
+        first.add_tag(Red)
+        self.assertTrue(Red in first)
+        self.assertFalse(Red in second)
+        self.assertRaises(toyblock.EntityComponentExistsError,
+                          first.add_tag, Red)
+        standalone = Entity(Enemy())
+        standalone.add_tag(Red)
+        self.assertEqual(set(red.entities), {first, standalone})
+        self.assertEqual(set(toyblock.entities_with(Red, Enemy)),
+                         {first, standalone})
+        self.assertEqual(set(toyblock.entities_with(Enemy, Brain)), {first, second})
+        standalone.del_tag(Red)
+        first.free()
+        self.assertFalse(Red in first)
+        self.assertEqual(list(red.entities), [])
+        self.assertEqual(toyblock.entities_with(Red), [])
+        self.assertTrue(pool.get() is first)
+        self.assertEqual(set(toyblock.entities_with(Enemy, Brain)), {first, second})
+
 class SystemTest(unittest.TestCase):
     def setUp(self):
 
@@ -249,3 +561,885 @@ class SystemTest(unittest.TestCase):
 
         print_entity.add_entity(Entity())
         print_entity()
+
+    def test6_batch(self):
+        class Body(object):
+            columns = {'x': 'd', 'vel_x': 'd'}
+            def __init__(self):
+                self.x = 0.
+                self.vel_x = 2.
+
+        calls = []
+
+        def move(system, entities, pool, dt):
+            calls.append(len(entities))
+            xs = pool.column(Body, 'x')
+            vel_xs = pool.column(Body, 'vel_x')
+            for i in system.slots(pool):
+                xs[i] += vel_xs[i]*dt
+            for entity in entities:
+                if entity.slot % 2: entity.free()
+
+        move = System(move, requires=(Body,), batch=True)
+        pool = Pool(4, (Body,), columnar=True)
+        entities = pool.get_many(4)
+        move(pool, 0.5)
+        self.assertEqual(calls, [4])
+        self.assertEqual([entity[Body].x for entity in entities], [1.]*4)
+        self.assertEqual(sorted(move.slots(pool)), [0, 2])
+        move(pool, 0.5)
+        self.assertEqual(calls, [4, 2])
+        self.assertEqual(pool.column(Body, 'x').tolist(), [2., 1., 2., 1.])
+
+    def test7_time_sliced(self):
+        seen = []
+
+        sliced = System(lambda system, entity: seen.append(entity),
+                        slice_size=2)
+        pool = Pool(6, (A,), systems=(sliced,))
+        entities = pool.get_many(5)
+        sliced()
+        self.assertEqual(seen, entities[:2])
+        self.assertEqual(sliced.pending, 3)
+        late = pool.get()
+        entities[2].free()
+        sliced()
+        self.assertEqual(seen, entities[:2] + entities[3:])
+        del seen[:]
+        for i in range(3):
+            sliced()
+        self.assertEqual(set(seen), {entities[0], entities[1], entities[3],
+                                     entities[4], late})
+
+        budgeted = System(lambda system, entities: seen.extend(entities),
+                          budget=0., batch=True)
+        budgeted.add_entities(entities)
+        del seen[:]
+        budgeted()
+        self.assertEqual(len(seen), 1)
+
+    def test8_components(self):
+        class A(object):
+            pass
+
+        class C(object):
+            pass
+
+        calls = []
+
+        def collect(system, entity, a, c, dt, scale=1):
+            calls.append((entity, a, c, dt*scale))
+
+        collect = System(collect, requires=(A,), components=(A, C))
+        entity = Entity(A())
+        collect(0.5)
+        self.assertEqual(calls, [(entity, entity[A], None, 0.5)])
+        del calls[:]
+        entity.add_component(C())
+        collect(0.5, scale=2)
+        self.assertEqual(calls, [(entity, entity[A], entity[C], 1.)])
+        del calls[:]
+        entity.del_component(C)
+        collect(1)
+        self.assertEqual(calls, [(entity, entity[A], None, 1)])
+        self.assertRaises(ValueError, System, collect, batch=True,
+                          components=(A,))
+
+    def test9_sorted(self):
+        class Sprite(toyblock.Tracked):
+            def __init__(self, z=0):
+                self.z = z
+
+        order = []
+        draw = System(lambda system, entity: order.append(entity[Sprite].z),
+                      requires=(Sprite,), key=lambda entity: entity[Sprite].z,
+                      key_types=(Sprite,))
+        sprites = [Entity(Sprite(z)) for z in (3, 1, 2, 1)]
+        draw()
+        self.assertEqual(order, [1, 1, 2, 3])
+        self.assertEqual(draw._sorted_entities[:2], [sprites[1], sprites[3]])
+        del order[:]
+        sprites[0][Sprite].z = 0
+        sprites[1].del_component(Sprite)
+        draw()
+        self.assertEqual(order, [0, 1, 2])
+        del order[:]
+        sprites[2][Sprite].__dict__['z'] = -1
+        draw()
+        self.assertEqual(order, [0, 1, -1])
+        del order[:]
+        draw.touch(sprites[2])
+        draw()
+        self.assertEqual(order, [-1, 0, 1])
+
+        def lift(system, entity):
+            if entity[Sprite].z == 0:
+                entity[Sprite].z = 10
+            order.append(entity[Sprite].z)
+
+        lift = System(lift, requires=(Sprite,), key=draw._key,
+                      key_types=(Sprite,))
+        del order[:]
+        lift()
+        lift()
+        self.assertEqual(order, [-1, 10, 1, -1, 1, 10])
+        del order[:]
+        sliced = System(lambda system, entity: order.append(entity[Sprite].z),
+                        requires=(Sprite,), key=draw._key, changed=(Sprite,),
+                        key_types=(Sprite,), slice_size=10)
+        sliced()
+        del order[:]
+        sprites[0][Sprite].z = 4
+        sprites[3][Sprite].z = 3
+        sprites[2][Sprite].z = 5
+        sliced()
+        self.assertEqual(order, [3, 4, 5])
+        unsorted = System(lambda system, entity: None, requires=(Sprite,))
+        self.assertGreater(lift.memory_report()["bytes"],
+                           unsorted.memory_report()["bytes"])
+
+    def test10_touch_from_threads(self):
+        class Body(toyblock.Tracked):
+            def __init__(self):
+                self.x = 0
+
+        entity = Entity(Body())
+        watch = System(lambda system, entity: None, changed=(Body,))
+        others = [System(lambda system, entity: None) for i in range(8)]
+        done = threading.Event()
+
+        def churn():
+            while not done.is_set():
+                for system in others:
+                    system.add_entity(entity)
+                for system in others:
+                    system.remove_entity(entity)
+
+        thread = threading.Thread(target=churn)
+        thread.start()
+        try:
+            watch.add_entity(entity)
+            for i in range(20000):
+                entity[Body].x = i
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(list(watch.changed), [entity])
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        class Body(object):
+            pass
+
+        class Graphic(object):
+            pass
+
+        class Hidden(object):
+            pass
+
+        self.Body = Body
+        self.Graphic = Graphic
+        self.Hidden = Hidden
+
+    def test1_requires(self):
+        Body, Graphic = self.Body, self.Graphic
+        before = Entity(Body(), Graphic())
+        only_body = Entity(Body())
+
+        @System
+        def manual(system, entity):
+            pass
+
+        draw = System(lambda system, entity: None, requires=(Body, Graphic))
+        self.assertEqual(list(draw.entities), [before])
+        after = Entity(Graphic(), Body())
+        self.assertTrue(after in draw)
+        self.assertFalse(only_body in draw)
+        self.assertFalse(before in manual)
+
+    def test2_add_del_component(self):
+        Body, Graphic, Hidden = self.Body, self.Graphic, self.Hidden
+        draw = System(lambda system, entity: None,
+                      requires=(Body, Graphic), excludes=(Hidden,))
+        entity = Entity(Body())
+        self.assertFalse(entity in draw)
+        entity.add_component(Graphic())
+        self.assertTrue(entity in draw)
+        entity.add_component(Hidden())
+        self.assertFalse(entity in draw)
+        entity.del_component(Hidden)
+        self.assertTrue(entity in draw)
+        entity.del_component(Body)
+        self.assertFalse(entity in draw)
+
+    def test3_pool(self):
+        Body, Graphic = self.Body, self.Graphic
+        physics = System(lambda system, entity: None, requires=(Body,))
+        pool = Pool(4, (Body, Graphic))
+        self.assertEqual(len(physics), 0)
+        one = pool.get()
+        many = pool.get_many(3)
+        self.assertEqual(list(physics.entities), [one] + many)
+        one.free()
+        self.assertFalse(one in physics)
+        pool.free_all()
+        self.assertEqual(len(physics), 0)
+
+    def test4_free_inside_query(self):
+        Body = self.Body
+        pool = Pool(4, (Body,))
+
+        def life(system, entity):
+            entity.free()
+
+        life = System(life, requires=(Body,))
+        pool.get_many(4)
+        life()
+        self.assertEqual(len(life), 0)
+        self.assertEqual(len(pool.get_many(4)), 4)
+
+    def test5_dead_query(self):
+        Body = self.Body
+        pool = Pool(2, (Body,))
+        physics = System(lambda system, entity: None, requires=(Body,))
+        one = pool.get()
+        self.assertEqual(len(one._archetype.systems), 1)
+        del physics
+        self.assertEqual(one._archetype.systems, ())
+        two = pool.get()
+        self.assertEqual(toyblock.entities_with(Body), [one, two])
+
+    def test6_dropped_pool(self):
+        Body = self.Body
+
+        def make():
+            pool = Pool(4, (Body,))
+            pool.get_many(3)[0].add_tag(self.Hidden)
+
+        make()
+        gc.collect()
+        self.assertEqual(toyblock.entities_with(Body), [])
+        physics = System(lambda system, entity: None, requires=(Body,))
+        self.assertEqual(len(physics), 0)
+
+class WorldTest(unittest.TestCase):
+    def test1_stages(self):
+        def nothing(system, entity, *args):
+            pass
+
+        physics = System(nothing)
+        ai = System(nothing)
+        audio = System(nothing)
+        draw = System(nothing)
+        world = toyblock.World()
+        world.add_system(physics, reads=(A,), writes=(A,))
+        world.add_system(ai, reads=(A,), writes=(B,))
+        world.add_system(audio, writes=(C,))
+        world.add_system(draw, reads=(A, B))
+        self.assertEqual(world.stages, ((physics, audio), (ai,), (draw,)))
+        world.remove_system(audio)
+        self.assertEqual(world.stages, ((physics,), (ai,), (draw,)))
+
+    def test2_run_in_threads(self):
+        class Left(object):
+            def __init__(self):
+                self.a = 0
+
+        class Right(object):
+            pass
+
+        calls = []
+
+        def count(system, entity, dt, name):
+            calls.append((name, dt))
+            if entity[Left].a % 2:
+                entity.free()
+
+        pool = Pool(100, (Left, Right))
+        one = System(count, requires=(Left,))
+        two = System(count, requires=(Right,))
+        world = toyblock.World(workers=2)
+        world.add_system(one, reads=(Left,), args=("one",))
+        world.add_system(two, reads=(Right,), args=("two",))
+        for i, entity in enumerate(pool.get_many(100)):
+            entity[Left].a = i
+        world(0.5)
+        world.close()
+        self.assertEqual(len(world.stages), 1)
+        #  An entity freed before the other system starts is not visited
+        self.assertTrue(50 <= calls.count(("one", 0.5)) <= 100)
+        self.assertTrue(50 <= calls.count(("two", 0.5)) <= 100)
+        self.assertEqual(len(one), 50)
+        self.assertEqual(len(two), 50)
+        self.assertEqual(len(pool.get_many(100)), 50)
+
+    def test3_rate(self):
+        steps = []
+
+        @System
+        def physics(system, entity, dt):
+            steps.append(dt)
+
+        physics.add_entity(Entity())
+        world = toyblock.World()
+        world.add_system(physics, rate=10, max_steps=3)
+        world(0.05)
+        self.assertEqual(steps, [])
+        self.assertAlmostEqual(world.alpha(physics), 0.5)
+        world(0.1)
+        self.assertEqual(steps, [0.1])
+        self.assertAlmostEqual(world.alpha(physics), 0.5)
+        world(1.)
+        self.assertEqual(len(steps), 4)
+        self.assertAlmostEqual(world.alpha(physics), 0.5)
+        self.assertRaises(ValueError, world.alpha, System(lambda *args: None))
+
+    def test4_budget(self):
+        @System
+        def slow(system, entity):
+            time.sleep(0.002)
+
+        calls = []
+
+        @System
+        def optional(system, entity):
+            calls.append(entity)
+
+        slow.add_entity(Entity())
+        optional.add_entity(Entity())
+        world = toyblock.World(budget=1.)
+        world.add_system(slow, writes=(A,))
+        world.add_system(optional, writes=(A,), priority=-1)
+        world()
+        self.assertEqual((calls, world.skipped), ([], (optional,)))
+        world = toyblock.World(budget=100.)
+        world.add_system(slow, writes=(A,))
+        world.add_system(optional, writes=(A,), priority=-1)
+        world()
+        self.assertEqual((len(calls), world.skipped), (1, ()))
+
+class CommandBufferTest(unittest.TestCase):
+    def test1_flush(self):
+        pool = Pool(4, (A,))
+        other = System(lambda system, entity: None)
+        first, second, third = pool.get_many(3)
+        standalone = Entity(A())
+        commands = toyblock.CommandBuffer()
+        commands.spawn(pool, lambda entity: setattr(entity[A], 'a', 7))
+        commands.spawn(pool)
+        commands.free(third)
+        commands.free(first)
+        commands.add_entity(other, second)
+        commands.add_entity(other, standalone)
+        commands.add_component(standalone, B())
+        self.assertEqual(len(commands), 7)
+        self.assertTrue(first in pool._used)
+        self.assertTrue(standalone[B] is None)
+        spawned = commands.flush()
+        self.assertEqual(len(commands), 0)
+        self.assertEqual(len(spawned), 2)
+        self.assertEqual(spawned[0][A].a, 7)
+        self.assertEqual(list(other.entities), [standalone, second])
+        self.assertTrue(standalone[B] is not None)
+        #  Frees are applied sorted by slot and before spawns
+        self.assertEqual(spawned, [third, first])
+        self.assertEqual(commands.flush(), [])
+
+    def test2_world(self):
+        class Life(object):
+            def __init__(self):
+                self.life = 1
+
+        freed = []
+
+        def life(system, entity):
+            world.commands.free(entity)
+            freed.append(len(system))
+
+        pool = Pool(3, (Life,))
+        system = System(life, requires=(Life,))
+        world = toyblock.World(workers=1)
+        world.add_system(system)
+        pool.get_many(3)
+        world()
+        #  Nothing was freed while the system was running
+        self.assertEqual(freed, [3, 3, 3])
+        self.assertEqual(len(system), 0)
+
+    def test3_error(self):
+        pool = Pool(2, (A,))
+        used = pool.get()
+        standalone = Entity(A())
+        commands = toyblock.CommandBuffer()
+        self.assertRaises(toyblock.EntityBelongsToPoolError,
+                          commands.add_component, used, B())
+        commands.free(used)
+        commands.add_component(standalone, A())
+        self.assertRaises(toyblock.EntityComponentExistsError, commands.flush)
+        self.assertEqual(len(commands), 1)
+        self.assertTrue(used in pool._used)
+        commands.flush()
+        self.assertFalse(used in pool._used)
+
+class AsyncTest(unittest.TestCase):
+    def test1_run_async(self):
+        order = []
+
+        def step(system, entity):
+            order.append("step")
+
+        async def other():
+            for i in range(3):
+                order.append("other")
+                await asyncio.sleep(0)
+
+        system = System(step)
+        system.add_entities([Entity() for i in range(4)])
+
+        async def main():
+            await asyncio.gather(system.run_async(yield_every=2), other())
+
+        asyncio.run(main())
+        self.assertEqual(order, ["step", "step", "other", "step", "step",
+                                 "other", "other"])
+
+    def test2_async_hooks(self):
+        loaded = []
+        pool = Pool(4, (A,))
+
+        @pool.init
+        async def load(entity):
+            await asyncio.sleep(0)
+            entity[A].a = 1
+            loaded.append(entity)
+
+        @pool.clean
+        async def save(entity):
+            await asyncio.sleep(0)
+            loaded.remove(entity)
+
+        self.assertRaises(TypeError, pool.get)
+
+        async def main():
+            entities = await pool.get_many_async(3, batch=2)
+            self.assertEqual([entity[A].a for entity in entities], [1, 1, 1])
+            self.assertEqual(len(loaded), 3)
+            await pool.free_many_async(entities[:2])
+            return entities
+
+        entities = asyncio.run(main())
+        self.assertEqual(loaded, entities[2:])
+        self.assertRaises(TypeError, entities[2].free)
+
+        @pool.clean
+        def forget(entity):
+            loaded.remove(entity)
+
+        entities[2].free()
+        self.assertEqual(loaded, [])
+        self.assertRaises(TypeError, pool.get_many, 1)
+
+    def test3_world(self):
+        calls = []
+
+        async def wait(system, entity, dt):
+            await asyncio.sleep(0)
+            calls.append(dt)
+
+        system = System(wait)
+        system.add_entity(Entity())
+        world = toyblock.World()
+        world.add_system(system, rate=4)
+        asyncio.run(world.run_async(0.5))
+        self.assertEqual(calls, [0.25, 0.25])
+
+    def test4_changed_meanwhile(self):
+        class Body(toyblock.Tracked):
+            def __init__(self):
+                self.x = 0
+
+        seen = []
+
+        def sync(system, entity):
+            seen.append(entity)
+            entity[Body].x += 1
+
+        sync = System(sync, requires=(Body,), changed=(Body,))
+        first, second = Entity(Body()), Entity(Body())
+
+        async def other():
+            first.set(Body, {"x": 10})
+
+        async def main():
+            await asyncio.gather(sync.run_async(yield_every=1), other())
+
+        asyncio.run(main())
+        self.assertEqual(seen, [first, second])
+        del seen[:]
+        sync()
+        self.assertEqual(seen, [first])
+
+    def test5_changed_while_awaiting(self):
+        class Pos(toyblock.Tracked):
+            def __init__(self):
+                self.x = 0
+
+        async def wait(system, entity):
+            await asyncio.sleep(0)
+
+        async def move():
+            entity[Pos].x = 1
+
+        watcher = System(wait, changed=(Pos,))
+        entity = Entity(Pos())
+        watcher.add_entity(entity)
+
+        async def main():
+            await asyncio.gather(watcher.run_async(), move())
+
+        asyncio.run(main())
+        self.assertEqual(list(watcher.changed), [entity])
+
+class SharedTest(unittest.TestCase):
+    def run_shards(self, processes):
+        spawned = []
+
+        def spawn(entity, x):
+            entity[Particle].life = 2
+            spawned.append(x)
+
+        with SharedPool(8, (Particle, A)) as pool:
+            entities = pool.get_many(6)
+            entities[0][Particle].life = 1
+            system = ShardedSystem(pool, _age, processes=processes,
+                                   spawn=spawn)
+            try:
+                system(1.5)
+            finally:
+                system.close()
+            self.assertEqual(list(pool.column(Particle, 'x')[:6]), [1.5]*6)
+            self.assertEqual(entities[3][Particle].life, 1)
+            self.assertEqual(spawned, [1.5])
+            self.assertEqual(len(pool._used), 6)
+            snapshot = pool.snapshot()
+            entities[3][Particle].x = 0.
+            pool.restore(snapshot)
+            self.assertEqual(entities[3][Particle].x, 1.5)
+
+    def test1_in_process(self):
+        self.run_shards(1)
+
+    def test2_processes(self):
+        self.run_shards(2)
+
+class HierarchyTest(unittest.TestCase):
+    def setUp(self):
+        class Transform(toyblock.Tracked):
+            def __init__(self):
+                self.x = 0.
+                self.world_x = 0.
+
+        updated = self.updated = []
+
+        def place(hierarchy, entity, parent):
+            updated.append(entity)
+            local = entity[Transform]
+            local.world_x = local.x
+            if parent is not None:
+                local.world_x += parent[Transform].world_x
+
+        self.Transform = Transform
+        self.pool = Pool(5, (Transform,))
+        self.scene = Hierarchy(place, changed=(Transform,))
+
+    def test1_propagation(self):
+        Transform, scene, updated = self.Transform, self.scene, self.updated
+        tank, turret, barrel, rock = self.pool.get_many(4)
+        scene.attach(turret, tank)
+        scene.attach(barrel, turret)
+        scene.add_entity(rock)
+        self.assertEqual(list(scene.walk()), [tank, rock, turret, barrel])
+        self.assertRaises(ValueError, scene.attach, tank, barrel)
+        for entity, x in ((tank, 10.), (turret, 1.), (barrel, 2.)):
+            entity[Transform].x = x
+        scene()
+        self.assertEqual(barrel[Transform].world_x, 13.)
+        del updated[:]
+        scene()
+        self.assertEqual(updated, [])
+        turret[Transform].x = 5.
+        scene()
+        self.assertEqual(updated, [turret, barrel])
+        self.assertEqual(barrel[Transform].world_x, 17.)
+        del updated[:]
+        scene.detach(turret)
+        scene()
+        self.assertEqual((scene.depth(barrel), barrel[Transform].world_x),
+                         (1, 7.))
+        self.assertEqual(scene.children(tank), ())
+
+    def test2_free(self):
+        scene = self.scene
+        tank, turret, barrel = self.pool.get_many(3)
+        standalone = Entity(self.Transform())
+        scene.attach(turret, tank)
+        scene.attach(barrel, turret)
+        scene.attach(standalone, tank)
+        tank.free()
+        self.assertEqual(list(scene.walk()), [standalone])
+        self.assertEqual(scene.parent(standalone), None)
+        self.assertEqual(len(self.pool.get_many(5)), 5)
+
+class ProfileTest(unittest.TestCase):
+    def test1_system(self):
+        @System
+        def life(system, entity):
+            entity.free()
+
+        pool = Pool(4, (A,), systems=(life,))
+        self.assertEqual(life.profile, None)
+        profile = life.enable_profiling(window=2)
+        pool.get_many(3)
+        life()
+        life()
+        snapshot = profile.snapshot()
+        self.assertEqual(snapshot["calls"], 2)
+        self.assertEqual(snapshot["entities"], 3)
+        self.assertEqual(snapshot["last_entities"], 0)
+        self.assertEqual(snapshot["removed"], 3)
+        self.assertEqual(snapshot["last_removed"], 0)
+        self.assertTrue(snapshot["total_time"] >= snapshot["last_time"])
+        self.assertEqual(sum(count for bound, count in profile.histogram(4)), 2)
+        life.disable_profiling()
+        life()
+        self.assertEqual(profile.calls, 2)
+
+    def test2_pool(self):
+        pool = Pool(4, (A,))
+        profile = pool.enable_profiling()
+        self.assertEqual(profile.histogram(), [])
+        entities = pool.get_many(3)
+        pool.get_many(3)
+        self.assertEqual(pool.get(), None)
+        pool.free_many(entities)
+        pool.get().free()
+        self.assertEqual(profile.snapshot(), {
+            "gets": 5, "frees": 4, "failures": 3, "high_water": 4,
+            "grows": 0, "shrinks": 0, "capacity": 4})
+
+class SpatialTest(unittest.TestCase):
+    def setUp(self):
+        class Position(object):
+            def __init__(self):
+                self.x = 0.
+                self.y = 0.
+
+        class Enemy(object):
+            pass
+
+        self.Position = Position
+        self.Enemy = Enemy
+        self.pool = Pool(10, (Position,))
+        self.enemies = Pool(10, (Position, Enemy))
+        self.grid = SpatialGrid(10., Position)
+
+    def spawn(self, x, y, pool=None):
+        entity = (pool or self.pool).get()
+        entity.set(self.Position, {'x': x, 'y': y})
+        self.grid.move(entity)
+        return entity
+
+    def test1_range_and_radius(self):
+        a = self.spawn(1., 1.)
+        b = self.spawn(15., 5.)
+        c = self.spawn(-25., 40.)
+        self.assertEqual(len(self.grid), 3)
+        self.assertEqual(self.grid.query_range(0., 0., 20., 20.), [a, b])
+        self.assertEqual(self.grid.query_radius(0., 0., 2.), [a])
+        c.free()
+        self.assertEqual(self.grid.query_range(-100., -100., 100., 100.),
+                         [a, b])
+
+    def test2_update_and_nearest(self):
+        a = self.spawn(1., 1.)
+        b = self.spawn(50., 50.)
+        self.assertEqual(self.grid.nearest(40., 40.), b)
+        b[self.Position].x = -50.
+        self.grid()
+        self.assertEqual(self.grid.nearest(40., 40.), a)
+        self.assertEqual(self.grid.nearest(40., 40., max_distance=10.), None)
+        self.assertEqual(self.grid.query_range(-60., 40., -40., 60.), [b])
+
+    def test3_pairs(self):
+        a = self.spawn(1., 1.)
+        b = self.spawn(12., 1.)
+        c = self.spawn(35., 1.)
+        pairs = list(self.grid.pairs())
+        self.assertEqual(len(pairs), 1)
+        self.assertEqual(set(pairs[0]), {a, b})
+        for one, other in self.grid.pairs():
+            one.free()
+            other.free()
+        self.assertEqual(list(self.grid.pairs()), [])
+        self.assertEqual(len(self.grid), 1)
+
+    def test4_pairs_with(self):
+        self.grid = SpatialGrid(10., self.Position, excludes=(self.Enemy,))
+        enemies = SpatialGrid(10., self.Position, requires=(self.Enemy,))
+        bullet = self.spawn(1., 1.)
+        enemy = self.spawn(5., 5., self.enemies)
+        enemies.move(enemy)
+        self.assertFalse(enemy in self.grid)
+        pairs = list(self.grid.pairs_with(enemies))
+        self.assertEqual(pairs, [(bullet, enemy)])
+        self.assertRaises(ValueError, list,
+                          self.grid.pairs_with(SpatialGrid(5., self.Position)))
+
+    def test5_tracked(self):
+        class Position(toyblock.Tracked):
+            def __init__(self):
+                self.x = 0.
+                self.y = 0.
+
+        pool = Pool(3, (Position,))
+        grid = SpatialGrid(10., Position)
+        a, b, c = pool.get_many(3)
+        self.assertEqual(len(grid.changed), 0)
+        b[Position].x = 25.
+        self.assertEqual(list(grid.changed), [b])
+        grid()
+        self.assertEqual(len(grid.changed), 0)
+        self.assertEqual(grid.query_range(20., 0., 30., 5.), [b])
+        c.free()
+        self.assertEqual(grid.query_range(-5., -5., 5., 5.), [a])
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        class Body(object):
+            columns = {'x': 'd', 'life': 'i'}
+            def __init__(self):
+                self.x = 0.
+                self.life = 3
+
+        class Name(object):
+            __slots__ = ('name',)
+            def __init__(self):
+                self.name = ""
+
+        @System
+        def physics(system, entity):
+            pass
+
+        self.Body = Body
+        self.Name = Name
+        self.physics = physics
+        self.pool = Pool(8, (Body, Name, A), columnar=True, systems=(physics,))
+
+    def test1_snapshot_restore(self):
+        Body, Name = self.Body, self.Name
+        first, second, third = self.pool.get_many(3)
+        first[Body].x = 1.
+        second[Name].name = "second"
+        third[A].a = 7
+        snapshot = self.pool.snapshot()
+        self.assertTrue(isinstance(snapshot, bytearray))
+        fourth = self.pool.get()
+        first.free()
+        second[Name].name = "changed"
+        third[A].a = 0
+        third[Body].life = 0
+        self.pool.restore(snapshot)
+        self.assertEqual(set(self.physics.entities), {first, second, third})
+        self.assertFalse(fourth in self.physics)
+        self.assertEqual(first[Body].x, 1.)
+        self.assertEqual(second[Name].name, "second")
+        self.assertEqual((third[A].a, third[Body].life), (7, 3))
+        self.assertEqual(len(self.pool.get_many(8)), 5)
+
+    def test2_buffer_and_types(self):
+        entity = self.pool.get()
+        entity[A].a = 5
+        buffer = bytearray(4096)
+        view = self.pool.snapshot(buffer, types=(A,))
+        entity[A].a = 1
+        self.pool.restore(buffer, types=(A,))
+        self.assertEqual(entity[A].a, 5)
+        self.assertRaises(ValueError, self.pool.snapshot, bytearray(4))
+        self.assertRaises(ValueError, self.pool.restore, view)
+        small = Pool(2, (self.Body, self.Name, A), columnar=True)
+        self.assertRaises(ValueError, small.restore, view, (A,))
+
+    def test3_save_load(self):
+        entity = self.pool.get()
+        entity[self.Body].x = 9.
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.pool.save(path)
+            entity.free()
+            self.pool.load(path)
+        finally:
+            os.remove(path)
+        self.assertTrue(entity in self.physics)
+        self.assertEqual(entity[self.Body].x, 9.)
+
+class ChangedTest(unittest.TestCase):
+    def setUp(self):
+        class Body(toyblock.Tracked):
+            columns = {'x': 'd'}
+            def __init__(self):
+                self.x = 0.
+
+        class Name(object):
+            def __init__(self):
+                self.name = ""
+
+        self.Body = Body
+        self.Name = Name
+
+    def test1_changed(self):
+        Body, Name = self.Body, self.Name
+        seen = []
+
+        def sync(system, entity):
+            seen.append(entity)
+
+        sync = System(sync, requires=(Body,), changed=(Body,))
+        pool = Pool(4, (Body, Name))
+        first, second = pool.get_many(2)
+        sync()
+        self.assertEqual(set(seen), {first, second})
+        del seen[:]
+        sync()
+        self.assertEqual(seen, [])
+        second[Body].x = 3.
+        first[Name].name = "not watched"
+        sync()
+        self.assertEqual(seen, [second])
+        del seen[:]
+        first.set(Name, {'name': "still not watched"})
+        first.touch(Body)
+        second.free()
+        sync()
+        self.assertEqual(seen, [first])
+
+    def test2_columnar_and_self_changes(self):
+        Body = self.Body
+
+        def move(system, entities):
+            for entity in entities:
+                entity[Body].x += 1.
+
+        move = System(move, requires=(Body,), changed=(Body,), batch=True)
+        pool = Pool(4, (Body,), columnar=True)
+        first, second = pool.get_many(2)
+        move()
+        self.assertEqual((first[Body].x, second[Body].x), (1., 1.))
+        move()
+        self.assertEqual(first[Body].x, 1.)
+        pool.column(Body, 'x')[first.slot] = 5.
+        self.assertEqual(len(move.changed), 0)
+        first[Body].x = 5.
+        self.assertEqual(list(move.changed), [first])
+        move()
+        self.assertEqual((first[Body].x, second[Body].x), (6., 1.))
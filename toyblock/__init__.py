@@ -13,10 +13,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ["Pool", "Entity", "System"]
+__all__ = ["Pool", "Entity", "System", "World", "Tracked",
+           "CommandBuffer", "entities_with", "memory_report"]
 
+from array import array
+import asyncio
+from bisect import bisect_left
 from collections import deque
-from weakref import proxy
+from copy import copy
+from inspect import isawaitable, iscoroutinefunction
+from keyword import iskeyword
+import mmap
+import pickle
+import struct
+from sys import getsizeof
+from types import ModuleType
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock, RLock, get_ident
+from time import perf_counter
+from weakref import (proxy, ref, WeakSet, WeakValueDictionary, ProxyType,
+                     CallableProxyType, ReferenceType)
 import warnings
 try:
     from itertools import zip_longest
@@ -24,6 +41,152 @@ except:
     print("Use Python3!")
     from itertools import izip_longest as zip_longest
 
+_MISSING = object()
+
+#  Archetypes by their set of component types, archetypes by each of
+#  their types, and systems declared with requires or excludes
+_archetypes = {}
+_archetypes_by_type = {}
+_queries = WeakSet()
+#  Every pool and system, for memory_report
+_all_pools = WeakSet()
+_all_systems = WeakSet()
+
+class _Archetype(object):
+    """Index of the entities which have exactly the same component types.
+
+    The query systems that match these types are cached here, so moving
+    an entity between archetypes only touches those systems.
+
+    The used entities of a pool with these types are found through the
+    pool, so getting and freeing them does not touch the index. Only the
+    entities without a pool and the pool entities with tags are indexed,
+    weakly, when they are created or change their types.
+    """
+
+    __slots__ = ('types', 'entities', 'pools', 'systems')
+
+    def __init__(self, types):
+        self.types = types
+        self.entities = WeakValueDictionary()
+        self.pools = WeakSet()
+        #  References to the matching systems, a tuple rebuilt when a
+        #  system is linked or dies so the hot paths iterate it cheaply
+        self.systems = ()
+        for system in _queries:
+            if system._matches(types):
+                self._link(system)
+
+    def _link(self, system):
+        self.systems += (system._ref,)
+        system._archetypes.append(self)
+        system.add_entities(self.all_entities())
+
+    def all_entities(self):
+        """Return a list with the entities of this archetype."""
+        found = []
+        for pool in list(self.pools):
+            found.extend(entity for entity in list(pool._used)
+                         if entity._archetype is self)
+        found.extend(self.entities.values())
+        return found
+
+def _system_died(system_ref):
+    """Unlink a dead system from the archetypes it matched."""
+    for archetype in list(_archetypes.values()):
+        if system_ref in archetype.systems:
+            archetype.systems = tuple(other for other in archetype.systems
+                                      if other is not system_ref)
+
+def _get_archetype(types):
+    """Return the archetype for the frozenset *types*, creating it if needed."""
+    archetype = _archetypes.get(types)
+    if archetype is None:
+        archetype = _archetypes[types] = _Archetype(types)
+        for type_ in types:
+            _archetypes_by_type.setdefault(type_, []).append(archetype)
+    return archetype
+
+def _deep_sizeof(obj, seen):
+    """Return the bytes of *obj* and of the objects it holds which are not
+    in *seen*.
+
+    Entities, pools, systems, classes, modules and weak references are
+    not followed, so a component which refers to another entity does
+    not count that entity.
+    """
+    not_sized = (Entity, Pool, System, type, ModuleType, ProxyType,
+                 CallableProxyType, ReferenceType)
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, not_sized):
+            continue
+        seen.add(id(obj))
+        size += getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for name in _slot_names(type(obj)):
+            value = getattr(obj, name, _MISSING)
+            if value is not _MISSING:
+                stack.append(value)
+    return size
+
+def memory_report():
+    """Return the memory used by all the pools and systems, in bytes.
+
+    Returns:
+        A dict with the :func:`Pool.memory_report` of each pool in
+        "pools", the :func:`System.memory_report` of each system in
+        "systems", the bytes of the archetype index in "index" and the
+        sum of all of them in "total".
+    """
+    pools = {pool: pool.memory_report() for pool in list(_all_pools)}
+    systems = {system: system.memory_report() for system in list(_all_systems)}
+    index = sum(getsizeof(archetype) + getsizeof(archetype.entities.data)
+                + getsizeof(archetype.pools.data)
+                + getsizeof(archetype.systems)
+                for archetype in list(_archetypes.values()))
+    index += getsizeof(_archetypes) + getsizeof(_archetypes_by_type)
+    total = (sum(report["total"] for report in pools.values())
+             + sum(report["bytes"] for report in systems.values()) + index)
+    return {"pools": pools, "systems": systems, "index": index, "total": total}
+
+def entities_with(*types):
+    """Return a list with the entities that have all the component types
+    or tags *types*, from a :class:`Pool` or not.
+
+    Only the entities of the archetypes with those types, and the used
+    entities of the pools with those types, are visited, so the cost
+    depends on the entities found and not on all the entities.
+
+    Getting and freeing pool entities does not update this index, but
+    each entity created without a pool, and each tag added or deleted,
+    is indexed in a :class:`weakref.WeakValueDictionary`. Creating many
+    short lived entities is cheaper with a :class:`Pool`.
+
+    Example:
+        .. code-block:: python
+
+            for enemy in toyblock.entities_with(Enemy, Red):
+                enemy[Brain].attack(player)
+    """
+    if not types:
+        return []
+    candidates = [_archetypes_by_type.get(type_, ()) for type_ in types]
+    wanted = frozenset(types)
+    found = []
+    for archetype in min(candidates, key=len):
+        if wanted <= archetype.types:
+            found.extend(archetype.all_entities())
+    return found
+
 class EntityError(Exception):
     pass
 
@@ -46,6 +209,37 @@ class EntityBelongsToPoolError(EntityError):
     def __str__(self):
         return "{} belongs to {}".format(self.entity, self.entity.pool)
 
+class Tracked(object):
+    """Base class for components whose attribute writes are tracked.
+
+    Setting an attribute of a tracked component calls :func:`Entity.touch`
+    on its entity, so the systems created with *changed* see the entity
+    in their next run. Components that do not inherit from this class
+    only mark the entity when you use :func:`Entity.set` or
+    :func:`Entity.touch`.
+
+    The views of a columnar :class:`Pool` are tracked too if their type
+    inherits from this class.
+
+    Example:
+        .. code-block:: python
+
+            class Body(toyblock.Tracked):
+                def __init__(self):
+                    self.x = 0.
+                    self.y = 0.
+
+            player[Body].x = 32.  # player is marked as changed
+    """
+
+    __slots__ = ('_entity',)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        entity = getattr(self, '_entity', None)
+        if entity is not None:
+            entity.touch(type(self))
+
 class Entity(object):
     """A bag where you group the components.
     
@@ -60,32 +254,81 @@ class Entity(object):
         EntityComponentExistsError: If the type of a instance is already used.
     """
 
-    __slots__ = ('_components', '_pool', '_systems')
+    __slots__ = ('_components', '_pool', '_systems', '_archetype', '_slot',
+                 '__weakref__')
 
     def __init__(self, *instances, pool=None):
         self._pool = pool
+        self._slot = None
         self._components = {}
-        add_component = self.add_component
+        self._systems = {}
+        self._archetype = None
+        if pool is not None:
+            if instances: raise EntityBelongsToPoolError(self)
+            return
+        add_component = self._add_component
         for instance in instances:
             add_component(instance)
-        self._systems = deque()
+        self._reindex()
 
     @property
     def pool(self):
         """You can check whether this entity belongs to a Pool. Read only."""
         return self._pool
 
+    @property
+    def slot(self):
+        """Index of this entity inside its :class:`Pool`, None if it does
+        not belong to a pool. Read only.
+        """
+        return self._slot
+
     def _add_system(self, system):
-        self._systems.append(system)
+        self._systems[system._ref] = None
 
     def _remove_system(self, system):
-        self._systems.remove(system)
+        self._systems.pop(system._ref, None)
 
     def _add_component(self, instance):
         type_ = type(instance)
         if type_ in self._components:
             raise EntityComponentExistsError(type_, self)
         self._components[type_] = instance
+        if isinstance(instance, Tracked):
+            object.__setattr__(instance, '_entity', self)
+
+    def _reindex(self):
+        """Move this entity to the archetype of its current components.
+
+        Only the query systems which differ between the old and the new
+        archetype are updated.
+        """
+        old = self._archetype
+        new = _get_archetype(frozenset(self._components))
+        if old is new: return
+        if old is not None:
+            old.entities.pop(id(self), None)
+        #  Pool entities without tags are found through their pool
+        if self._pool is None or new is not self._pool._archetype:
+            new.entities[id(self)] = self
+        self._archetype = new
+        new_systems = new.systems
+        if old is None:
+            for system_ref in new_systems:
+                system_ref().add_entity(self)
+            return
+        old_systems = old.systems
+        for system_ref in old_systems:
+            if system_ref not in new_systems:
+                system_ref().remove_entity(self)
+        for system_ref in new_systems:
+            if system_ref not in old_systems:
+                system_ref().add_entity(self)
+        #  Components passed by the systems that stay may have changed
+        for system_ref in list(self._systems):
+            system = system_ref()
+            if system is not None and system._component_types:
+                system._refresh(self)
 
     def add_component(self, instance):
         """Add a component instance to this entity.
@@ -99,6 +342,53 @@ class Entity(object):
         """
         if self._pool is not None: raise EntityBelongsToPoolError(self)
         self._add_component(instance)
+        self._reindex()
+
+    def add_tag(self, tag):
+        """Add the tag *tag* to this entity.
+
+        A tag is a class used as a component without an instance. It can
+        be required or excluded by a :class:`System`, checked with
+        ``tag in entity`` and found with :func:`entities_with`. Unlike
+        components, tags can be added to the used entities of a
+        :class:`Pool`. They are removed when the entity is freed.
+
+        Parameters:
+            tag (class)
+
+        Raises:
+            EntityComponentExistsError: If *tag* is already used.
+            EntityError: If this entity belongs to a Pool and it is not used.
+
+        Example:
+            .. code-block:: python
+
+                class Red:
+                    pass
+
+                enemy.add_tag(Red)
+                red_team = toyblock.System(attack, requires=(Enemy, Red))
+        """
+        if self._pool is not None and self._archetype is None:
+            raise EntityError("{} is not used".format(self))
+        if tag in self._components:
+            raise EntityComponentExistsError(tag, self)
+        self._components[tag] = tag
+        self._reindex()
+
+    def del_tag(self, tag):
+        """Remove the tag *tag* from this entity, if it has it."""
+        components = self._components
+        if components.get(tag) is not tag: return
+        del components[tag]
+        self._reindex()
+
+    def _del_tags(self):
+        """Remove all the tags without reindexing."""
+        components = self._components
+        for tag in [type_ for type_, instance in components.items()
+                    if type_ is instance]:
+            del components[tag]
 
     def __getitem__(self, type_):
         """This is a convenient, less verbose, way to get a component
@@ -136,7 +426,12 @@ class Entity(object):
             The removed instance from this entity, or None if not exists.
         """
         if self._pool is not None: raise EntityBelongsToPoolError(self)
-        return self._components.pop(type_, None)
+        instance = self._components.pop(type_, None)
+        if instance is not None:
+            if isinstance(instance, Tracked):
+                object.__setattr__(instance, '_entity', None)
+            self._reindex()
+        return instance
 
     def set(self, type_, dict_):
         """Convenient method for setting attributes to a component with a dict.
@@ -161,6 +456,39 @@ class Entity(object):
         component = self[type_]
         for key in dict_:
             setattr(component, key, dict_[key])
+        self.touch(type_)
+
+    def touch(self, type_):
+        """Mark the component *type_* of this entity as changed.
+
+        The systems of this entity that watch *type_*, see the *changed*
+        parameter of :class:`System`, process it in their next run. The
+        systems sorted by a key which depends on *type_*, see
+        *key_types*, move it to its place when their next run starts,
+        also if they are running now. Changes made by the callable of a
+        system are not seen by that system, changes made meanwhile by
+        other threads or tasks are. The awaitables returned by the
+        callable to :func:`System.run_async` run along other tasks, so
+        their changes are seen.
+
+        Parameters:
+            type\_: Type of the changed component.
+        """
+        #  A copy, other threads may add or remove this entity meanwhile
+        for system_ref in tuple(self._systems):
+            system = system_ref()
+            if system is None:
+                continue
+            key_changed = type_ in system._key_types
+            watched = type_ in system._watches
+            if not key_changed and not watched:
+                continue
+            with system._mutex:
+                if key_changed:
+                    system._unsorted[self] = None
+                #  Skip the writes of the callable of the system itself
+                if watched and system._runner != get_ident():
+                    system._changed[self] = None
 
     def free(self):
         """
@@ -183,9 +511,137 @@ class Entity(object):
         self._pool._free(self)
 
     def __contains__(self, item):
-        if isinstance(item, System): return item in self._systems
+        if isinstance(item, System): return item._ref in self._systems
         return item in self._components
 
+class Profile(object):
+    """Base of the counters recorded by :func:`System.enable_profiling`
+    and :func:`Pool.enable_profiling`.
+
+    The last *window* samples are kept to build a rolling histogram.
+    """
+    def __init__(self, window=120):
+        self._samples = deque(maxlen=window)
+
+    def snapshot(self):
+        """Return a dict with the current counters."""
+        return {}
+
+    def histogram(self, bins=10):
+        """Return a rolling histogram of the last samples.
+
+        Parameters:
+            bins (int): Number of bins.
+
+        Returns:
+            A list of *(upper_bound, count)* tuples, one per bin. It is
+            empty if there are no samples yet.
+        """
+        samples = self._samples
+        if not samples:
+            return []
+        low = min(samples)
+        width = (max(samples) - low)/bins
+        counts = [0]*bins
+        for sample in samples:
+            i = int((sample - low)/width) if width else 0
+            counts[min(i, bins - 1)] += 1
+        return [(low + width*(i + 1), count) for i, count in enumerate(counts)]
+
+class SystemProfile(Profile):
+    """Counters of a :class:`System`. Samples are wall times in seconds."""
+    def __init__(self, window=120):
+        super(SystemProfile, self).__init__(window)
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+        self.entities = 0
+        self.last_entities = 0
+        self.added = 0
+        self.removed = 0
+        self.last_added = 0
+        self.last_removed = 0
+
+    def _record(self, elapsed, entities, added, removed):
+        self.calls += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+        self.entities += entities
+        self.last_entities = entities
+        self.added += added
+        self.removed += removed
+        self.last_added = added
+        self.last_removed = removed
+        self._samples.append(elapsed)
+
+    def snapshot(self):
+        """Return a dict with the current counters.
+
+        *added* and *removed* are the deferred entities flushed at the
+        end of the runs.
+        """
+        return {
+            "calls": self.calls,
+            "total_time": self.total_time,
+            "last_time": self.last_time,
+            "mean_time": self.total_time/self.calls if self.calls else 0.0,
+            "entities": self.entities,
+            "last_entities": self.last_entities,
+            "added": self.added,
+            "removed": self.removed,
+            "last_added": self.last_added,
+            "last_removed": self.last_removed,
+        }
+
+class PoolProfile(Profile):
+    """Counters of a :class:`Pool`. Samples are the used entities after
+    each get or free.
+    """
+    def __init__(self, window=120):
+        super(PoolProfile, self).__init__(window)
+        self.gets = 0
+        self.frees = 0
+        self.failures = 0
+        self.high_water = 0
+        self.grows = 0
+        self.shrinks = 0
+        self.capacity = 0
+
+    def _record_get(self, wanted, got, used):
+        self.gets += got
+        self.failures += wanted - got
+        if used > self.high_water:
+            self.high_water = used
+        self._samples.append(used)
+
+    def _record_resize(self, old, new):
+        if new > old:
+            self.grows += 1
+        else:
+            self.shrinks += 1
+        self.capacity = new
+
+    def _record_free(self, freed, used):
+        self.frees += freed
+        self._samples.append(used)
+
+    def snapshot(self):
+        """Return a dict with the current counters.
+
+        *failures* counts the entities requested while the pool was
+        exhausted and *high_water* is the maximum of used entities.
+        *grows* and *shrinks* count the changes of *capacity*.
+        """
+        return {
+            "gets": self.gets,
+            "frees": self.frees,
+            "failures": self.failures,
+            "high_water": self.high_water,
+            "grows": self.grows,
+            "shrinks": self.shrinks,
+            "capacity": self.capacity,
+        }
+
 class System(object):
     """Define how are entities processed here.
 
@@ -196,6 +652,38 @@ class System(object):
     
     Parameters:
         callable\_: A callable
+        requires (iterable of classes, optional): Component types that an
+            entity must have to be added automatically to this system.
+        excludes (iterable of classes, optional): Component types that an
+            entity must not have to be added automatically to this system.
+        batch (bool): Call *callable_* once per run with all the entities
+            instead of once per entity.
+        changed (iterable of classes, optional): Only process the entities
+            that joined this system or whose components of these types
+            changed since the previous run.
+        components (iterable of classes, optional): Component types passed
+            to *callable_* after the entity, see below.
+        key (callable, optional): Process the entities sorted by
+            *key(entity)*. Entities with the same key keep the order in
+            which they were added.
+        key_types (iterable of classes, optional): Component types whose
+            change, see :func:`Entity.touch`, changes the key.
+        slice_size (int, optional): Process at most this number of
+            entities per run.
+        budget (float, optional): Stop processing entities when a run
+            took this number of milliseconds.
+
+    With *slice_size* or *budget* the system is time sliced: each run
+    continues the sweep over the entities where the previous run stopped,
+    and a new sweep starts when all of them were processed. Entities
+    removed in the middle of a sweep are skipped and entities added are
+    processed in the next sweep. At least one entity is processed per run.
+
+    If *requires* or *excludes* are given then the system is a query. Any
+    entity, from a :class:`Pool` or not, whose components match is added
+    to the system and removed when it stops matching. Entities are indexed
+    by their set of component types (archetype) so only the matching
+    archetypes are visited. You can still add other entities by hand.
     
     .. note::
     
@@ -205,8 +693,45 @@ class System(object):
         
             callable(system, entity, *args, **kwargs)
 
+        or, for a *batch* system,
+
+        .. code-block:: python
+
+            callable(system, entities, *args, **kwargs)
+
+        or, with *components*,
+
+        .. code-block:: python
+
+            callable(system, entity, *components, *args, **kwargs)
+
+        where *components* are the components of the entity of those
+        types, or None if it does not have one. They are looked up once,
+        when the entity joins the system or its components change.
+
+        For a *batch* system *entities* is the same view as
+        :attr:`entities`, the
+        changed entities if *changed* is given, or an iterator over the
+        slice of a time sliced system. Use :func:`slots` to work on the
+        columns of a columnar :class:`Pool`.
+
+    With *key* the order is kept as entities join and leave, with a
+    binary search, instead of sorting all of them each run. If the key of
+    an entity changes call :func:`touch`, or give *key_types* to do it
+    when those components change.
+
+    A component is marked as changed by :func:`Entity.set`,
+    :func:`Entity.touch` or, if it inherits from :class:`Tracked`, by
+    setting any of its attributes.
+
     Returns:
         A System instance which is callable.
+
+    .. note::
+
+        Entities are kept in an insertion ordered dict, so adding,
+        removing and checking an entity cost O(1). Entities are processed
+        in the order they were added.
     
     Raises:
         TypeError: If you do not pass a callable.
@@ -222,26 +747,247 @@ class System(object):
             physics.add_entity(some_entity)
             # ...
             physics(get_delta_time())
+
+            def draw(system, entity, canvas):
+                pass
+
+            draw = toyblock.System(draw, requires=(Body, Graphic),
+                                   excludes=(Hidden,))
+
+            def move(system, entities, dt):
+                xs = bullets.column(Body, 'x')
+                vel_xs = bullets.column(Body, 'vel_x')
+                for i in system.slots(bullets):
+                    xs[i] += vel_xs[i]*dt
+
+            move = toyblock.System(move, requires=(Body,), batch=True)
+
+            def sync(system, entity, socket):
+                socket.send(entity[Body].x, entity[Body].y)
+
+            sync = toyblock.System(sync, requires=(Body,), changed=(Body,))
+
+            pathfinding = toyblock.System(find_path, requires=(Brain,),
+                                          budget=2.)
+
+            def collide(system, entity, body, collision, dt):
+                collision.update(body.x, body.y)
+
+            collide = toyblock.System(collide, requires=(Body, Collision),
+                                      components=(Body, Collision))
+
+            draw = toyblock.System(draw, requires=(Sprite,),
+                                   key=lambda entity: entity[Sprite].z,
+                                   key_types=(Sprite,))
     """
-    def __init__(self, callable_):
+    def __init__(self, callable_, requires=None, excludes=None, batch=False,
+                 changed=None, slice_size=None, budget=None, components=None,
+                 key=None, key_types=None):
         if not callable(callable_):
             raise TypeError("Pass a callable object to the constructor")
         self._callable_ = callable_
-        self._entities = deque()
+        self._ref = ref(self, _system_died)
+        self._entities = {}
+        self._batch = batch
+        self._slots = {}
         self._locked = False
+        #  Thread ident while the callable runs, see Entity.touch
+        self._runner = None
+        #  Reentrant, so hooks can add or remove entities
+        self._mutex = RLock()
+        self._profile = None
+        self._watches = frozenset(() if changed is None else changed)
+        self._changed = {}
+        if self._watches:
+            self._hooks = True
+        if slice_size is not None and slice_size < 1:
+            raise ValueError("slice_size must be at least 1")
+        if components is not None and batch:
+            raise ValueError("components can not be used with batch")
+        #  With components the entities dict holds the tuple of components
+        self._component_types = tuple(components or ())
+        #  With key, (key, order) and entities in parallel sorted lists
+        self._key = key
+        self._key_types = frozenset(() if key_types is None else key_types)
+        self._sort_keys = {}
+        self._sorted_keys = []
+        self._sorted_entities = []
+        self._unsorted = {}
+        self._order = count()
+        if key is not None:
+            self._hooks = True
+        self._slice_size = slice_size
+        self._budget = budget
+        self._sliced = slice_size is not None or budget is not None
+        #  Entities left in the current sweep of a time sliced system
+        self._pending = deque()
+        self._slice_count = 0
         self._entities_removed = deque()
         self._entities_added = deque()
 
         #Remap some methods
         self._entities_added_append = self._entities_added.append
-        self._entities_append = self._entities.append
         self._entities_removed_append = self._entities_removed.append
-        self._entities_remove = self._entities.remove
+        self._entities_pop = self._entities.pop
+
+        self._requires = frozenset(() if requires is None else requires)
+        self._excludes = frozenset(() if excludes is None else excludes)
+        self._archetypes = []
+        _all_systems.add(self)
+        if requires is not None or excludes is not None:
+            _queries.add(self)
+            for archetype in list(_archetypes.values()):
+                if self._matches(archetype.types):
+                    archetype._link(self)
 
     @property
     def entities(self):
-        """Get the entities added to this system."""
-        return self._entities
+        """Get a read only view of the entities added to this system."""
+        return self._entities.keys()
+
+    @property
+    def changed(self):
+        """Get a read only view of the entities that changed since the
+        previous run of this system.
+        """
+        return self._changed.keys()
+
+    @property
+    def pending(self):
+        """Number of entities left in the current sweep of a time sliced
+        system, including the ones removed meanwhile. Read only.
+        """
+        return len(self._pending)
+
+    def _slice(self):
+        """Yield the entities of the next slice of the current sweep."""
+        pending = self._pending
+        if not pending:
+            if self._watches:
+                with self._mutex:
+                    changed = self._changed
+                    self._changed = {}
+                if self._key is not None:
+                    changed = sorted(changed, key=self._sort_keys.__getitem__)
+                pending.extend(changed)
+            elif self._key is not None:
+                pending.extend(self._sorted_entities)
+            else:
+                pending.extend(self._entities)
+        members = self._entities
+        limit = self._slice_size
+        deadline = None
+        if self._budget is not None:
+            deadline = perf_counter() + self._budget/1000.
+        popleft = pending.popleft
+        count = 0
+        while pending:
+            if limit is not None and count >= limit:
+                break
+            if deadline is not None and count and perf_counter() >= deadline:
+                break
+            entity = popleft()
+            if entity not in members:
+                continue
+            count += 1
+            self._slice_count = count
+            yield entity
+
+    @property
+    def requires(self):
+        """Component types required by this system. Read only."""
+        return self._requires
+
+    @property
+    def excludes(self):
+        """Component types excluded by this system. Read only."""
+        return self._excludes
+
+    def slots(self, pool):
+        """Return the slots of the entities of this system that belong to
+        *pool*, in the same order as :attr:`entities`.
+
+        The result is an *array('l')* suitable to index the columns of a
+        columnar :class:`Pool`. It is cached until the entities of this
+        system change, so do not modify it.
+
+        Parameters:
+            pool (Pool)
+        """
+        slots = self._slots.get(pool)
+        if slots is None:
+            pool_proxy = pool._proxy
+            slots = array('l', [entity._slot for entity in self._entities
+                                if entity._pool is pool_proxy])
+            self._slots[pool] = slots
+        return slots
+
+    @property
+    def profile(self):
+        """The :class:`SystemProfile` of this system, or None if profiling
+        is disabled. Read only.
+        """
+        return self._profile
+
+    def memory_report(self):
+        """Return the memory used to keep track of the entities of this
+        system.
+
+        Returns:
+            A dict with the number of "entities" and the "bytes" of the
+            bookkeeping of this system, not of the entities.
+        """
+        with self._mutex:
+            size = (getsizeof(self) + getsizeof(self._entities)
+                    + getsizeof(self._changed) + getsizeof(self._pending)
+                    + getsizeof(self._entities_added)
+                    + getsizeof(self._entities_removed)
+                    + getsizeof(self._slots)
+                    + sum(getsizeof(slots) for slots in self._slots.values()))
+            if self._component_types:
+                size += sum(getsizeof(components)
+                            for components in self._entities.values())
+            if self._key is not None:
+                size += (getsizeof(self._sort_keys) + getsizeof(self._unsorted)
+                         + getsizeof(self._sorted_keys)
+                         + getsizeof(self._sorted_entities)
+                         + sum(getsizeof(sort_key) for sort_key
+                               in self._sort_keys.values()))
+            return {"entities": len(self._entities), "bytes": size}
+
+    def enable_profiling(self, window=120):
+        """Record calls, wall time, processed entities and deferred
+        changes of this system.
+
+        Profiling costs nothing when it is disabled.
+
+        Parameters:
+            window (int): Number of calls kept for the histogram.
+
+        Returns:
+            A new :class:`SystemProfile`.
+        """
+        self._profile = SystemProfile(window)
+        return self._profile
+
+    def disable_profiling(self):
+        """Stop profiling this system."""
+        self._profile = None
+
+    def _matches(self, types):
+        return self._requires <= types and self._excludes.isdisjoint(types)
+
+    def _components_of(self, entity):
+        if not self._component_types:
+            return None
+        get = entity._components.get
+        return tuple([get(type_) for type_ in self._component_types])
+
+    def _refresh(self, entity):
+        """Look up again the components passed with *entity*."""
+        with self._mutex:
+            if entity in self._entities:
+                self._entities[entity] = self._components_of(entity)
 
     def add_entity(self, entity):
         """Add an entity to this System.
@@ -250,12 +996,15 @@ class System(object):
             entity (Entity)
         
         """
-        if self in entity: return
-        if self._locked:
-            self._entities_added_append(entity)
-        else:
-            self._entities_append(entity)
-            entity._add_system(proxy(self))
+        with self._mutex:
+            if self in entity: return
+            if self._locked:
+                self._entities_added_append(entity)
+            else:
+                self._entities[entity] = self._components_of(entity)
+                entity._add_system(self)
+                if self._slots: self._slots.clear()
+                if self._hooks: self._entity_added(entity)
 
     def remove_entity(self, entity):
         """Remove an entity from this System.
@@ -264,35 +1013,280 @@ class System(object):
             entity (Entity)
         
         """
-        if self not in entity: return
-        if self._locked:
-            self._entities_removed_append(entity)
-        else:
-            self._entities_remove(entity)
-            entity._remove_system(self)
+        with self._mutex:
+            if self not in entity: return
+            if self._locked:
+                #  The entity stops being a member now, so a second
+                #  removal is ignored, but it is popped when the run ends
+                entity._remove_system(self)
+                self._entities_removed_append(entity)
+            else:
+                self._entities_pop(entity, None)
+                entity._remove_system(self)
+                if self._slots: self._slots.clear()
+                if self._hooks: self._entity_removed(entity)
+
+    def add_entities(self, entities):
+        """Add several entities to this System at once.
+
+        This is faster than calling :func:`add_entity` for each entity.
+
+        Parameters:
+            entities (iterable of Entity)
+
+        """
+        ref_ = self._ref
+        with self._mutex:
+            if self._locked:
+                self._entities_added.extend(
+                    entity for entity in entities if ref_ not in entity._systems)
+                return
+            own = self._entities
+            hooks = self._hooks
+            components_of = self._components_of
+            for entity in entities:
+                systems = entity._systems
+                if ref_ in systems: continue
+                own[entity] = components_of(entity)
+                systems[ref_] = None
+                if hooks: self._entity_added(entity)
+            if self._slots: self._slots.clear()
+
+    def remove_entities(self, entities):
+        """Remove several entities from this System at once.
+
+        This is faster than calling :func:`remove_entity` for each entity.
+
+        Parameters:
+            entities (iterable of Entity)
+
+        """
+        ref_ = self._ref
+        with self._mutex:
+            if self._locked:
+                for entity in entities:
+                    systems = entity._systems
+                    if ref_ in systems:
+                        del systems[ref_]
+                        self._entities_removed_append(entity)
+                return
+            own_pop = self._entities_pop
+            hooks = self._hooks
+            for entity in entities:
+                systems = entity._systems
+                if ref_ not in systems: continue
+                own_pop(entity, None)
+                del systems[ref_]
+                if hooks: self._entity_removed(entity)
+            if self._slots: self._slots.clear()
 
     def __call__(self, *args, **kwargs):
         """Run the system.
         
         It is perfectly safe add entities to the system or remove entities from the system.
+        The changes are applied when the run ends, even from other threads.
         """
-        if self._locked: return
-        entities = self._entities
+        with self._mutex:
+            if self._locked: return
+            self._locked = True
+            entities = self._run_entities()
+        sliced = self._sliced
         callable_ = self._callable_
-        self._locked = True
-        for entity in entities:
-            callable_(self, entity, *args, **kwargs)
-        self._locked = False
+        profile = self._profile
+        if profile is not None:
+            start = perf_counter()
+            processed = None if sliced else len(entities)
+        self._runner = get_ident()
+        try:
+            if self._batch:
+                if isinstance(entities, dict):
+                    entities = entities.keys()
+                callable_(self, entities, *args, **kwargs)
+            elif self._component_types:
+                if kwargs:
+                    for entity, components in self._with_components(entities):
+                        callable_(self, entity, *components, *args, **kwargs)
+                else:
+                    for entity, components in self._with_components(entities):
+                        callable_(self, entity, *components, *args)
+            else:
+                for entity in entities:
+                    callable_(self, entity, *args, **kwargs)
+        finally:
+            self._runner = None
+            with self._mutex:
+                self._locked = False
+                if profile is not None:
+                    added = len(self._entities_added)
+                    removed = len(self._entities_removed)
+                self._flush()
+        if profile is not None:
+            if processed is None:
+                processed = self._slice_count
+            profile._record(perf_counter() - start, processed, added, removed)
+
+    async def run_async(self, *args, yield_every=64, **kwargs):
+        """Run the system as a coroutine.
+
+        The control is given back to the event loop every *yield_every*
+        entities, so a long run does not stall other tasks. If the
+        callable returns an awaitable, for example if it is a coroutine
+        function, it is awaited. Entities added or removed meanwhile are
+        applied when the run ends, as with :func:`__call__`.
+
+        Example:
+            .. code-block:: python
+
+                async def tick(dt):
+                    await physics.run_async(dt, yield_every=256)
+        """
+        with self._mutex:
+            if self._locked: return
+            self._locked = True
+            entities = self._run_entities()
+        sliced = self._sliced
+        callable_ = self._callable_
+        profile = self._profile
+        if profile is not None:
+            start = perf_counter()
+            processed = None if sliced else len(entities)
+        runner = get_ident()
+        try:
+            if self._batch:
+                if isinstance(entities, dict):
+                    entities = entities.keys()
+                self._runner = runner
+                result = callable_(self, entities, *args, **kwargs)
+                self._runner = None
+                if isawaitable(result):
+                    await result
+            else:
+                count = 0
+                if self._component_types:
+                    entities = self._with_components(entities)
+                else:
+                    entities = ((entity, ()) for entity in entities)
+                for entity, components in entities:
+                    self._runner = runner
+                    result = callable_(self, entity, *components, *args,
+                                       **kwargs)
+                    #  Other tasks may run from now on, their changes
+                    #  must be seen
+                    self._runner = None
+                    if isawaitable(result):
+                        await result
+                    count += 1
+                    if count == yield_every:
+                        count = 0
+                        await asyncio.sleep(0)
+        finally:
+            self._runner = None
+            with self._mutex:
+                self._locked = False
+                if profile is not None:
+                    added = len(self._entities_added)
+                    removed = len(self._entities_removed)
+                self._flush()
+        if profile is not None:
+            if processed is None:
+                processed = self._slice_count
+            profile._record(perf_counter() - start, processed, added, removed)
+
+    def _run_entities(self):
+        """Return the entities to process in this run. Call it with the
+        mutex acquired.
+        """
+        if self._unsorted:
+            self._resort()
+        if self._sliced:
+            self._slice_count = 0
+            return self._slice()
+        if self._watches:
+            entities = self._changed
+            self._changed = {}
+            if self._key is not None:
+                return sorted(entities, key=self._sort_keys.__getitem__)
+            return entities
+        if self._key is not None:
+            return self._sorted_entities
+        return self._entities
+
+    def _insert_sorted(self, entity):
+        sort_key = (self._key(entity), next(self._order))
+        self._sort_keys[entity] = sort_key
+        index = bisect_left(self._sorted_keys, sort_key)
+        self._sorted_keys.insert(index, sort_key)
+        self._sorted_entities.insert(index, entity)
+
+    def _remove_sorted(self, entity):
+        sort_key = self._sort_keys.pop(entity, None)
+        if sort_key is None:
+            return
+        index = bisect_left(self._sorted_keys, sort_key)
+        del self._sorted_keys[index]
+        del self._sorted_entities[index]
+
+    def _resort(self):
+        unsorted = self._unsorted
+        self._unsorted = {}
+        for entity in unsorted:
+            if entity in self._sort_keys:
+                self._remove_sorted(entity)
+                self._insert_sorted(entity)
+
+    def touch(self, entity):
+        """Move *entity* to its place after its sort key changed.
+
+        Only for systems with *key*. If this system is running the entity
+        is moved when the next run starts.
+        """
+        with self._mutex:
+            if self._locked:
+                self._unsorted[entity] = None
+            elif entity in self._sort_keys:
+                self._remove_sorted(entity)
+                self._insert_sorted(entity)
+
+    def _with_components(self, entities):
+        """Return an iterable of (entity, components) for *entities*."""
+        members = self._entities
+        if entities is members:
+            return members.items()
+        return ((entity, members[entity]) for entity in entities)
+
+    def _flush(self):
+        """Apply the entities added and removed while this system was running."""
+        entities = self._entities
         entities_removed = self._entities_removed
         entities_added = self._entities_added
+        if self._slots and (entities_removed or entities_added):
+            self._slots.clear()
+        hooks = self._hooks
         while len(entities_removed):
             entity = entities_removed.pop()
-            entities.remove(entity)
+            if entities.pop(entity, _MISSING) is _MISSING: continue
             entity._remove_system(self)
+            if hooks: self._entity_removed(entity)
         while len(entities_added):
             entity = entities_added.pop()
-            entities.append(entity)
-            entity._add_system(proxy(self))
+            if entity in entities: continue
+            entities[entity] = self._components_of(entity)
+            entity._add_system(self)
+            if hooks: self._entity_added(entity)
+
+    #  Subclasses that need to know when an entity joins or leaves the
+    #  system set _hooks to True and override these methods
+    _hooks = False
+
+    def _entity_added(self, entity):
+        if self._watches: self._changed[entity] = None
+        if self._key is not None: self._insert_sorted(entity)
+
+    def _entity_removed(self, entity):
+        if self._watches: self._changed.pop(entity, None)
+        if self._key is not None:
+            self._remove_sorted(entity)
+            self._unsorted.pop(entity, None)
 
     def __contains__(self, entity):
         return self in entity
@@ -300,6 +1294,137 @@ class System(object):
     def __len__(self):
         return len(self._entities)
 
+class _ColumnView(object):
+    """Base class of the components returned by a columnar :class:`Pool`.
+
+    The attributes of a view are read from and written to the columns of
+    the pool at the slot of the entity.
+    """
+
+    __slots__ = ('_slot',)
+
+    def __init__(self, slot):
+        self._slot = slot
+
+    def __repr__(self):
+        return "<{} slot={}>".format(type(self).__name__, self._slot)
+
+def _column_property(column, type_=None, entities=None):
+    def get(self):
+        return column[self._slot]
+    def set_(self, value):
+        column[self._slot] = value
+    def set_tracked(self, value):
+        slot = self._slot
+        column[slot] = value
+        entities[slot].touch(type_)
+    return property(get, set_ if entities is None else set_tracked)
+
+_SNAPSHOT_MAGIC = b"TBK1"
+#  magic, capacity, used entities, columns, object types, pickled bytes
+_SNAPSHOT_HEADER = struct.Struct("<4sIIIII")
+
+def _resetter(prototype):
+    """Return a function which restores the attributes of a list of
+    instances to the ones of *prototype*.
+
+    The values are shared with the prototype, except the attributes named
+    in the *reset_copy* attribute of its type, which are copied with
+    :func:`copy.copy`. The function is generated with one assignment per attribute, like
+    :mod:`dataclasses` does, because it is several times faster than
+    looping over the attributes.
+    """
+    class_ = type(prototype)
+    state = _get_state(prototype)
+    copied = getattr(class_, "reset_copy", ())
+    namespace = {"copy": copy, "set_": object.__setattr__,
+                 "del_": object.__delattr__}
+    lines = ["def reset(instances):", "    for instance in instances:"]
+    for i, (name, value) in enumerate(state.items()):
+        value_name = "value{}".format(i)
+        namespace[value_name] = value
+        if name in copied:
+            value_name = "copy({})".format(value_name)
+        if (issubclass(class_, Tracked) or not name.isidentifier()
+            or iskeyword(name)):
+            lines.append("        set_(instance, {!r}, {})".format(name, value_name))
+        else:
+            lines.append("        instance.{} = {}".format(name, value_name))
+    if not hasattr(prototype, "__dict__"):
+        #  Slots which were not set in the prototype
+        for name in _slot_names(class_):
+            if name not in state:
+                lines.append("        if hasattr(instance, {0!r}): "
+                             "del_(instance, {0!r})".format(name))
+    if len(lines) == 2:
+        lines.append("        pass")
+    exec("\n".join(lines), namespace)
+    return namespace["reset"]
+
+def _typecode(column):
+    """Return the typecode of an array or a memoryview column."""
+    try:
+        return column.typecode
+    except AttributeError:
+        return column.format
+
+def _get_state(instance):
+    """Return a dict with the attributes of *instance*."""
+    try:
+        return dict(instance.__dict__)
+    except AttributeError:
+        return {name: getattr(instance, name) for name in _slot_names(type(instance))
+                if hasattr(instance, name)}
+
+def _set_state(instance, state):
+    """Set the attributes of *instance* from a dict made by _get_state."""
+    try:
+        attributes = instance.__dict__
+    except AttributeError:
+        for name, value in state.items():
+            setattr(instance, name, value)
+        return
+    attributes.clear()
+    attributes.update(state)
+
+def _slot_names(class_):
+    names = []
+    for klass in class_.__mro__:
+        if klass is Tracked: continue
+        slots = getattr(klass, "__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(name for name in slots
+                     if name not in ("__dict__", "__weakref__"))
+    return names
+
+#  Class attributes of a columnar type which are not copied to its view
+_NOT_COPIED = frozenset(("__dict__", "__weakref__", "__slots__", "__init__",
+                         "__new__", "__module__", "__qualname__"))
+
+def _column_view(type_, columns, entities):
+    """Create a view class for *type_* over the dict of arrays *columns*.
+
+    The methods and class attributes of *type_* are copied to the view.
+    If *type_* is :class:`Tracked` writes touch the entity of the slot,
+    taken from the list *entities*.
+    """
+    namespace = {}
+    for klass in reversed(type_.__mro__):
+        if klass is object or klass is Tracked: continue
+        slots = getattr(klass, "__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name, value in vars(klass).items():
+            if name not in _NOT_COPIED and name not in slots:
+                namespace[name] = value
+    namespace['__slots__'] = ()
+    if not issubclass(type_, Tracked):
+        entities = None
+    for name, column in columns.items():
+        namespace[name] = _column_property(column, type_, entities)
+    return type(type_.__name__ + "View", (_ColumnView,), namespace)
+
 class Pool(object):
     """Manage entities and manage systems related to entities.
     
@@ -309,9 +1434,100 @@ class Pool(object):
         args_list (iterable): A list of args for the classes.
         kwargs_list (iterable): A list of kwargs for the classes.
         systems (iterable of System): Systems related with these entities.
+        columnar (bool): Store the fields of the types which declare
+            *columns* in contiguous arrays, one per field.
+        growth (None, 'double' or int): How to grow when the pool is
+            exhausted. None keeps *maxlen* entities, 'double' doubles the
+            capacity and an int adds that number of entities.
+        max_size (int or None): Maximum capacity of a growing pool.
+        shrink_after (int or None): Number of :func:`tick` calls after
+            which the idle capacity is released.
+        lazy (bool): Build the entities when they are needed for the first
+            time instead of in the constructor.
+        reset (bool): Restore the components of the freed entities to
+            their initial state, see below.
     
     Returns:
         A instance of Pool.
+
+    Raises:
+        ValueError: If a columnar type has attributes which are not in
+            its *columns*.
+
+    A type declares its columns with a dict of field names and
+    :mod:`array` typecodes. In a columnar pool the component of such a type
+    is a lightweight view: reading or writing one of its attributes reads
+    or writes the array at the slot of the entity. The initial value of
+    each field is taken from an instance built with the args of the type.
+    Use :func:`column` to get the whole array of a field.
+
+    The view has the methods and class attributes of the type, but it is
+    not an instance of it, so ``isinstance(entity[Body], Body)`` is
+    False, and it can only hold the fields in *columns*. A
+    :class:`ValueError` is raised if an instance of the type has other
+    attributes.
+
+    With *reset* a prototype of each type is built with its args and its
+    attributes are set on the components of the entities when they are
+    freed, after the clean function. Attributes that the prototype does
+    not have are kept. The values are shared with the prototype, so a
+    reference to a shared resource, like a texture, stays the same. List
+    the attributes which need a new value for each entity, like a list,
+    in a *reset_copy* attribute of the type and they are copied from the
+    prototype with :func:`copy.copy`. The columns are refilled with their
+    initial values, a run of contiguous slots at a time. Most clean
+    functions are not needed then. If the clean function or a reset
+    raises, the entity is kept used.
+
+    .. code-block:: python
+
+        class Inventory:
+            reset_copy = ('items',)
+            def __init__(self):
+                self.texture = textures['bag']  # shared
+                self.items = []  # a new list for each freed entity
+
+    .. code-block:: python
+
+        class Body:
+            columns = {'x': 'd', 'y': 'd'}
+            def __init__(self):
+                self.x = 0.0
+                self.y = 0.0
+
+        bullets = toyblock.Pool(50000, (Body, Graphic), columnar=True)
+        bullet = bullets.get()
+        bullet[Body].x = 32.
+        xs = bullets.column(Body, 'x')  # array('d'), indexed by Entity.slot
+
+    A pool with *growth* builds new entities, with the same types and
+    args, when :func:`get` or :func:`get_many` find it exhausted. With
+    *shrink_after* the pool releases, every *shrink_after* frames, the
+    avaliable entities above the maximum number of entities used in those
+    frames, never below *maxlen*. Only entities at the end of the pool can
+    be released. Call :func:`tick` once per frame and use :func:`resize` to
+    be told of every change of capacity.
+
+    .. code-block:: python
+
+        particles = toyblock.Pool(256, (Body,), growth='double',
+                                  max_size=65536, shrink_after=600)
+
+        @particles.resize
+        def log_resize(pool, old, new):
+            print("particles", old, "->", new)
+
+    A *lazy* pool builds an entity the first time :func:`get` needs it, so
+    the startup cost depends on the entities actually used. Use
+    :func:`prewarm` or :func:`prewarm_step`, during a loading screen for
+    example, to build them in advance.
+
+    .. code-block:: python
+
+        sprites = toyblock.Pool(10000, (Body, Sprite), lazy=True)
+
+        while sprites.prewarm_step(4.):  # 4 ms per frame
+            draw_loading_screen()
         
     Example:
         .. code-block:: python
@@ -334,31 +1550,356 @@ class Pool(object):
             pool = toyblock.Pool(10, (A, B, C), args, kwargs, systems=(input, physics, touch, life))
     
     """
-    def __init__(self, maxlen, types, args_list=(), kwargs_list=(), systems=None):
+    def __init__(self, maxlen, types, args_list=(), kwargs_list=(), systems=None,
+                 columnar=False, growth=None, max_size=None, shrink_after=None,
+                 lazy=False, reset=False):
+        if growth is not None and growth != "double" and growth < 1:
+            raise ValueError("growth must be None, 'double' or a positive int")
         self._init = None
         self._clean = None
+        self._async_init = False
+        self._async_clean = False
+        self._resize = None
         self._systems = systems
-        self._avaliable = deque(maxlen=maxlen)
-        avaliable_append = self._avaliable.append
+        self._archetype = _get_archetype(frozenset(types))
+        self._archetype.pools.add(self)
+        self._avaliable = deque()
+        self._proxy = proxy(self)
+        #  Guards the partition between avaliable and used entities
+        self._lock = Lock()
+        self._profile = None
+        self._min_size = maxlen
+        self._size = maxlen
+        self._lazy = lazy
+        self._growth = growth
+        self._max_size = max_size
+        self._shrink_after = shrink_after
+        self._idle_frames = 0
+        self._idle_peak = 0
+        self._used_peak = 0
+        self._memory_peak = 0
+        #  Bumped each time the entity of a slot is freed
+        self._generations = array('L', (0,))*maxlen
         EMPTY_TUPLE = ()
         EMPTY_DICT = {}
-        for i in range(maxlen):
-            entity = Entity(pool=proxy(self))
-            entity_add_component = entity._add_component
-            for type_, type_args, type_kwargs in zip_longest(types, args_list, kwargs_list):
-                args = EMPTY_TUPLE if type_args is None else type_args
-                kwargs = EMPTY_DICT if type_kwargs is None else type_kwargs
-                instance = type_(*args, **kwargs)
-                entity_add_component(instance)
-            avaliable_append(entity)
-        self._used = deque(maxlen=maxlen)
+        self._types = []
+        self._columns = {}
+        self._column_defaults = {}
+        self._views = {}
+        self._entities = []
+        _all_pools.add(self)
+        for type_, type_args, type_kwargs in zip_longest(types, args_list, kwargs_list):
+            args = EMPTY_TUPLE if type_args is None else type_args
+            kwargs = EMPTY_DICT if type_kwargs is None else type_kwargs
+            self._types.append((type_, args, kwargs))
+            if columnar and hasattr(type_, "columns"):
+                prototype = type_(*args, **kwargs)
+                extra = [name for name in _get_state(prototype)
+                         if name not in type_.columns]
+                if extra:
+                    raise ValueError("{} has attributes which are not in its "
+                                     "columns: {}".format(type_.__name__,
+                                                          ", ".join(extra)))
+                defaults = {name: getattr(prototype, name, 0)
+                            for name in type_.columns}
+                columns = {
+                    name: array(typecode, (defaults[name],))*maxlen
+                    for name, typecode in type_.columns.items()
+                }
+                self._columns[type_] = columns
+                self._column_defaults[type_] = defaults
+                self._views[type_] = _column_view(type_, columns, self._entities)
+        self._resets = None
+        if reset:
+            self._resets = [(type_, _resetter(type_(*args, **kwargs)))
+                            for type_, args, kwargs in self._types
+                            if type_ not in self._columns]
+        if not lazy:
+            self._build(maxlen)
+        #  Used entities are kept in a dict for O(1) membership and removal
+        self._used = {}
 
         #Remap methods to be used directly
         self._avaliable_pop = self._avaliable.pop
-        self._used_append = self._used.append
-        self._used_remove = self._used.remove
         self._avaliable_append = self._avaliable.append
 
+    def _build_entity(self, slot):
+        """Create the entity of *slot* with its components."""
+        entity = Entity(pool=self._proxy)
+        entity._slot = slot
+        components = entity._components
+        entity_add_component = entity._add_component
+        views = self._views
+        for type_, args, kwargs in self._types:
+            view = views.get(type_)
+            if view is None:
+                entity_add_component(type_(*args, **kwargs))
+            else:
+                components[type_] = view(slot)
+        self._entities.append(entity)
+        return entity
+
+    @property
+    def capacity(self):
+        """Number of entities this pool can hold without growing. Read only."""
+        return self._size
+
+    @property
+    def built(self):
+        """Number of entities already built. Read only."""
+        return len(self._entities)
+
+    def prewarm(self, n=None):
+        """Build up to *n* entities of a lazy pool, all of them if *n* is
+        None.
+
+        Returns:
+            The number of entities built.
+        """
+        with self._lock:
+            return self._build(self._size if n is None else n)
+
+    def prewarm_step(self, budget_ms):
+        """Build entities of a lazy pool for about *budget_ms* milliseconds.
+
+        At least one entity is built if there is any left.
+
+        Returns:
+            The number of entities that are not built yet.
+        """
+        end = perf_counter() + budget_ms/1000.
+        while self.prewarm(1) and perf_counter() < end:
+            pass
+        return self._size - len(self._entities)
+
+    def _build(self, n):
+        """Build up to *n* entities and make them avaliable.
+
+        It must be called with the lock acquired. Returns the number of
+        entities built.
+        """
+        start = len(self._entities)
+        end = min(start + n, self._size)
+        for slot in range(start, end):
+            self._build_entity(slot)
+        #  Below the avaliable entities, so lower slots are used first
+        self._avaliable.extendleft(self._entities[start:])
+        return end - start
+
+    def _reserve(self, n):
+        """Try to have *n* avaliable entities, building or growing.
+
+        It must be called with the lock acquired. Returns the old and the
+        new capacity if the pool grew, None otherwise.
+        """
+        missing = n - len(self._avaliable)
+        if missing <= 0:
+            return None
+        missing -= self._build(missing)
+        if missing <= 0:
+            return None
+        resized = self._grow(missing)
+        self._build(missing)
+        return resized
+
+    def resize(self, resize_):
+        """The resize function is called when the pool grows or shrinks.
+
+        Parameters:
+            resize\_ (callable): Signature is resize_(pool, old, new)
+
+        Returns:
+            The same callable passed as parameter.
+
+        Raises:
+            TypeError: if resize\_ is not callable.
+        """
+        if not callable(resize_):
+            raise TypeError("Pass a callable object")
+        self._resize = resize_
+        return resize_
+
+    def _grow(self, needed):
+        """Make room for at least *needed* entities if the growth policy
+        allows it. The new entities are built unless the pool is lazy.
+
+        It must be called with the lock acquired. Returns the old and the
+        new capacity, or None if the pool did not grow.
+        """
+        old = self._size
+        growth = self._growth
+        if growth is None:
+            return None
+        if growth == "double":
+            new = max(old*2, old + needed)
+        else:
+            new = old + -(-needed//growth)*growth
+        if self._max_size is not None:
+            new = min(new, self._max_size)
+        if new <= old:
+            return None
+        for type_, columns in self._columns.items():
+            defaults = self._column_defaults[type_]
+            for name, column in columns.items():
+                column.extend(array(column.typecode, (defaults[name],))*(new - old))
+        #  Generations are kept on shrink, so old handles stay invalid
+        generations = self._generations
+        if len(generations) < new:
+            generations.extend(array('L', (0,))*(new - len(generations)))
+        self._size = new
+        if not self._lazy:
+            self._build(new - old)
+        if self._profile is not None:
+            self._profile._record_resize(old, new)
+        return old, new
+
+    def _shrink(self, target):
+        """Release the avaliable entities at the end of the pool down to
+        *target* entities.
+        """
+        with self._lock:
+            entities = self._entities
+            old = self._size
+            built = len(entities)
+            avaliable = set(self._avaliable)
+            while built > target and entities[built - 1] in avaliable:
+                built -= 1
+            new = max(built, min(target, old))
+            if new == old:
+                return
+            kept = [entity for entity in self._avaliable if entity._slot < built]
+            self._avaliable.clear()
+            self._avaliable.extend(kept)
+            del entities[built:]
+            self._size = new
+            for columns in self._columns.values():
+                for column in columns.values():
+                    del column[new:]
+            if self._profile is not None:
+                self._profile._record_resize(old, new)
+        if self._resize is not None:
+            self._resize(self, old, new)
+
+    def tick(self):
+        """Tell the pool that a frame has passed.
+
+        It is only needed for pools with *shrink_after*.
+        """
+        if self._shrink_after is None:
+            return
+        used = len(self._used)
+        self._idle_frames += 1
+        if self._idle_frames < self._shrink_after:
+            return
+        target = max(self._min_size, self._idle_peak)
+        self._idle_frames = 0
+        self._idle_peak = used
+        self._shrink(target)
+
+    def column(self, type_, name):
+        """Return the array which stores the field *name* of *type_*.
+
+        The array is indexed by :attr:`Entity.slot`. It supports the buffer
+        protocol, so it can be wrapped without copying, for example with
+        *numpy.frombuffer*.
+
+        Raises:
+            KeyError: If *type_* is not stored in columns in this pool.
+        """
+        return self._columns[type_][name]
+
+    @property
+    def profile(self):
+        """The :class:`PoolProfile` of this pool, or None if profiling is
+        disabled. Read only.
+        """
+        return self._profile
+
+    def memory_report(self):
+        """Return the memory used by this pool, in bytes.
+
+        The components are sized deeply: the attributes of each component
+        and the objects they hold are counted, but not the entities,
+        pools, systems or classes they refer to. An object shared by
+        several components is counted once. The column of a columnar type
+        counts its whole array plus the views.
+
+        Returns:
+            A dict with:
+
+            - "components": dict of bytes per component type.
+            - "entities": bytes of the entities, their component dicts and
+              their system dicts.
+            - "bookkeeping": bytes of the lists of avaliable, used and
+              built entities and of the generations.
+            - "total": sum of the above.
+            - "per_entity": *total* divided by the built entities.
+            - "built", "used" and "capacity": number of entities.
+            - "peak_used": the most entities used at once.
+            - "peak": the highest *total* reported by this pool.
+
+        Example:
+            .. code-block:: python
+
+                report = bullets.memory_report()
+                for type_, size in report["components"].items():
+                    print(type_.__name__, size)
+        """
+        with self._lock:
+            entities = list(self._entities)
+            used = len(self._used)
+            bookkeeping = (getsizeof(self._avaliable) + getsizeof(self._used)
+                           + getsizeof(self._entities)
+                           + getsizeof(self._generations))
+        seen = set()
+        components = {}
+        for type_, args, kwargs in self._types:
+            columns = self._columns.get(type_)
+            if columns is None:
+                size = sum(_deep_sizeof(entity._components[type_], seen)
+                           for entity in entities)
+            else:
+                size = sum(getsizeof(column) + (0 if isinstance(column, array)
+                                                else column.nbytes)
+                           for column in columns.values())
+                size += sum(getsizeof(entity._components[type_])
+                            for entity in entities)
+            components[type_] = size
+        overhead = sum(getsizeof(entity) + getsizeof(entity._components)
+                       + getsizeof(entity._systems) for entity in entities)
+        total = sum(components.values()) + overhead + bookkeeping
+        self._memory_peak = max(self._memory_peak, total)
+        return {
+            "components": components,
+            "entities": overhead,
+            "bookkeeping": bookkeeping,
+            "total": total,
+            "per_entity": total/len(entities) if entities else 0.,
+            "built": len(entities),
+            "used": used,
+            "capacity": self._size,
+            "peak_used": self._used_peak,
+            "peak": self._memory_peak,
+        }
+
+    def enable_profiling(self, window=120):
+        """Record gets, frees, failed gets and the high water mark of
+        used entities. Use it to tune *maxlen*.
+
+        Parameters:
+            window (int): Number of samples kept for the histogram.
+
+        Returns:
+            A new :class:`PoolProfile`.
+        """
+        self._profile = PoolProfile(window)
+        self._profile.capacity = self._size
+        return self._profile
+
+    def disable_profiling(self):
+        """Stop profiling this pool."""
+        self._profile = None
+
     def init(self, init_):
         """Called when :func:`get` returns a instance of :class:`Entity`.
         
@@ -384,6 +1925,7 @@ class Pool(object):
         if not callable(init_):
             raise TypeError("Pass a callable object.")
         self._init = init_
+        self._async_init = iscoroutinefunction(init_)
         return init_
 
     def clean(self, clean_):
@@ -409,22 +1951,187 @@ class Pool(object):
         if not callable(clean_):
             raise TypeError("Pass a callable object")
         self._clean = clean_
+        self._async_clean = iscoroutinefunction(clean_)
         return clean_
 
+    def _sync_init(self):
+        raise TypeError("The init function of this pool is a coroutine "
+                        "function, use get_many_async")
+
+    def _sync_clean(self):
+        raise TypeError("The clean function of this pool is a coroutine "
+                        "function, use free_many_async")
+
     def get(self):
         """Return a free :class:`Entity` if avaliable, None otherwise."""
-        if not self._avaliable:
-            return None
-        entity = self._avaliable_pop()
-        self._used_append(entity)
+        if self._async_init: self._sync_init()
+        with self._lock:
+            resized = self._reserve(1) if not self._avaliable else None
+            if not self._avaliable:
+                if self._profile is not None:
+                    self._profile._record_get(1, 0, len(self._used))
+                return None
+            entity = self._avaliable_pop()
+            used = self._used
+            used[entity] = None
+            if len(used) > self._idle_peak:
+                self._idle_peak = len(used)
+                if len(used) > self._used_peak:
+                    self._used_peak = len(used)
+            if self._profile is not None:
+                self._profile._record_get(1, 1, len(used))
+        if resized is not None and self._resize is not None:
+            self._resize(self, *resized)
         if self._init is not None:
             self._init(entity)
+        archetype = self._archetype
+        entity._archetype = archetype
+        if archetype.systems:
+            for system_ref in archetype.systems:
+                system_ref().add_entity(entity)
         if self._systems is None:
             return entity
         for system in self._systems:
             system.add_entity(entity)
         return entity
 
+    def get_many(self, n):
+        """Return a list with up to *n* free entities.
+
+        The init function is called for each entity and every system of
+        this pool is updated once for the whole batch.
+
+        Parameters:
+            n (int): Number of entities wanted.
+
+        Returns:
+            A list of :class:`Entity`. It is shorter than *n* if there are
+            not enough avaliable entities.
+        """
+        if self._async_init: self._sync_init()
+        entities = self._take(n)
+        init = self._init
+        if init is not None:
+            for entity in entities:
+                init(entity)
+        self._attach(entities)
+        return entities
+
+    async def get_many_async(self, n, batch=64):
+        """Return a list with up to *n* free entities, as a coroutine.
+
+        The same as :func:`get_many` but the init function can be a
+        coroutine function. Then it is run concurrently for *batch*
+        entities at a time.
+
+        Example:
+            .. code-block:: python
+
+                @players.init
+                async def load_player(entity):
+                    entity[Profile].data = await database.load(entity)
+
+                new_players = await players.get_many_async(10)
+        """
+        entities = self._take(n)
+        await _run_hook(self._init, entities, batch)
+        self._attach(entities)
+        return entities
+
+    def _take(self, n):
+        """Move up to *n* avaliable entities to used and return them."""
+        avaliable_pop = self._avaliable_pop
+        with self._lock:
+            resized = self._reserve(n)
+            wanted = n
+            n = min(n, len(self._avaliable))
+            entities = [avaliable_pop() for i in range(n)]
+            self._used.update(dict.fromkeys(entities))
+            if len(self._used) > self._idle_peak:
+                self._idle_peak = len(self._used)
+                if len(self._used) > self._used_peak:
+                    self._used_peak = len(self._used)
+            if self._profile is not None:
+                self._profile._record_get(wanted, n, len(self._used))
+        if resized is not None and self._resize is not None:
+            self._resize(self, *resized)
+        return entities
+
+    def _attach(self, entities):
+        """Index a batch of used entities and add them to their systems."""
+        archetype = self._archetype
+        for entity in entities:
+            entity._archetype = archetype
+        for system_ref in archetype.systems:
+            system_ref().add_entities(entities)
+        if self._systems is not None:
+            for system in self._systems:
+                system.add_entities(entities)
+
+    def _detach(self, entities):
+        """Remove a batch of entities from the index and their systems."""
+        archetype = self._archetype
+        tagged = []
+        for entity in entities:
+            if entity._archetype is not archetype:
+                tagged.append(entity)
+                continue
+            entity._archetype = None
+        for system_ref in archetype.systems:
+            system_ref().remove_entities(entities)
+        for entity in tagged:
+            own = entity._archetype
+            if own is not None:
+                own.entities.pop(id(entity), None)
+                for system_ref in own.systems:
+                    system_ref().remove_entity(entity)
+            entity._archetype = None
+            entity._del_tags()
+        if self._systems is not None:
+            for system in self._systems:
+                system.remove_entities(entities)
+        _leave_systems(entities)
+
+    def free_many(self, entities):
+        """Release several entities at once.
+
+        Entities that are not used are ignored. The clean function is
+        called for each entity and every system of this pool is updated
+        once for the whole batch.
+
+        Parameters:
+            entities (iterable of Entity)
+        """
+        if self._async_clean: self._sync_clean()
+        used_pop = self._used.pop
+        with self._lock:
+            batch = [entity for entity in entities
+                     if used_pop(entity, _MISSING) is not _MISSING]
+        self._release(batch)
+
+    async def free_many_async(self, entities, batch=64):
+        """Release several entities at once, as a coroutine.
+
+        The same as :func:`free_many` but the clean function can be a
+        coroutine function. Then it is run concurrently for *batch*
+        entities at a time.
+        """
+        used_pop = self._used.pop
+        with self._lock:
+            freed = [entity for entity in entities
+                     if used_pop(entity, _MISSING) is not _MISSING]
+        try:
+            await _run_hook(self._clean, freed, batch)
+        except BaseException:
+            self._keep_used(freed)
+            raise
+        self._recycle(freed)
+
+    def _keep_used(self, entities):
+        """Put back in used the entities whose clean or reset raised."""
+        with self._lock:
+            self._used.update(dict.fromkeys(entities))
+
     def free(self, entity):
         """
             .. deprecated:: 2.0.0
@@ -435,16 +2142,764 @@ class Pool(object):
 
     def free_all(self):
         """Release all the used entities."""
-        while len(self._used):
-            self._free(self._used[0])
+        if self._async_clean: self._sync_clean()
+        with self._lock:
+            batch = list(self._used)
+            self._used.clear()
+        self._release(batch)
+
+    def _release(self, entities):
+        """Make avaliable a batch of entities already removed from used."""
+        clean = self._clean
+        if clean is not None:
+            try:
+                for entity in entities:
+                    clean(entity)
+            except BaseException:
+                self._keep_used(entities)
+                raise
+        self._recycle(entities)
+
+    def _recycle(self, entities):
+        """Make avaliable a batch of entities already cleaned."""
+        if self._resets is not None:
+            try:
+                self._reset(entities)
+            except BaseException:
+                self._keep_used(entities)
+                raise
+        self._detach(entities)
+        with self._lock:
+            self._bump(entities)
+            self._avaliable.extend(entities)
+            if self._profile is not None:
+                self._profile._record_free(len(entities), len(self._used))
 
     def _free(self, entity):
         """Mark the instance to be avaliable."""
-        if entity not in self._used: return
-        self._used.remove(entity)
-        self._avaliable.append(entity)
-        if self._clean is not None:
-            self._clean(entity)
-        if self._systems is None: return
-        for system in self._systems:
-            system.remove_entity(entity)
+        if self._async_clean: self._sync_clean()
+        with self._lock:
+            if self._used.pop(entity, _MISSING) is _MISSING: return
+        try:
+            if self._clean is not None:
+                self._clean(entity)
+            if self._resets is not None:
+                self._reset((entity,))
+        except BaseException:
+            self._keep_used((entity,))
+            raise
+        archetype = self._archetype
+        if entity._archetype is not archetype:
+            self._detach((entity,))
+        else:
+            entity._archetype = None
+            if archetype.systems:
+                for system_ref in archetype.systems:
+                    system_ref().remove_entity(entity)
+            if self._systems is not None:
+                for system in self._systems:
+                    system.remove_entity(entity)
+            if entity._systems:
+                _leave_systems((entity,))
+        with self._lock:
+            self._bump((entity,))
+            self._avaliable_append(entity)
+            if self._profile is not None:
+                self._profile._record_free(1, len(self._used))
+
+    def _reset(self, entities):
+        """Restore the components of *entities* from the prototypes."""
+        for type_, reset in self._resets:
+            reset([entity._components[type_] for entity in entities])
+        if not self._columns or not entities:
+            return
+        #  Runs of contiguous slots, refilled with one slice assignment
+        slots = sorted(entity._slot for entity in entities)
+        runs = []
+        start = end = slots[0]
+        for slot in slots[1:]:
+            if slot != end + 1:
+                runs.append((start, end + 1))
+                start = slot
+            end = slot
+        runs.append((start, end + 1))
+        longest = max(stop - start for start, stop in runs)
+        for type_, columns in self._columns.items():
+            defaults = self._column_defaults[type_]
+            for name, column in columns.items():
+                default = defaults[name]
+                fill = array(_typecode(column), (default,))*longest
+                for start, stop in runs:
+                    if stop - start == 1:
+                        column[start] = default
+                    else:
+                        column[start:stop] = fill[:stop - start]
+
+    def _bump(self, entities):
+        """Invalidate the handles of *entities*. Call it with the lock."""
+        generations = self._generations
+        for entity in entities:
+            slot = entity._slot
+            generations[slot] = (generations[slot] + 1) & 0xFFFFFFFF
+
+    def handle(self, entity):
+        """Return an int which identifies *entity* while it is used.
+
+        A handle packs the slot of the entity in its lower 32 bits and a
+        generation, incremented each time the slot is freed, in the upper
+        32 bits. Handles are cheap to store, for example in an
+        *array('Q')* column, and :func:`resolve` detects when the entity
+        was freed even if its slot is used again.
+
+        Parameters:
+            entity (Entity): A used entity of this pool.
+
+        Returns:
+            The handle, an int.
+
+        Raises:
+            ValueError: If *entity* is not used from this pool.
+
+        Example:
+            .. code-block:: python
+
+                target = enemies.handle(enemy)
+                # ...
+                enemy = enemies.resolve(target)
+                if enemy is None:
+                    pass  # it was freed, look for another target
+        """
+        if entity not in self._used:
+            raise ValueError("{} is not used from this pool".format(entity))
+        slot = entity._slot
+        return self._generations[slot] << 32 | slot
+
+    def resolve(self, handle):
+        """Return the entity of *handle*, or None if it was freed."""
+        slot = handle & 0xFFFFFFFF
+        entities = self._entities
+        if (slot >= len(entities)
+            or self._generations[slot] != handle >> 32):
+            return None
+        entity = entities[slot]
+        if entity not in self._used:
+            return None
+        return entity
+
+    def is_valid(self, handle):
+        """Return True if the entity of *handle* is still used."""
+        return self.resolve(handle) is not None
+
+    def _object_types(self, types):
+        if types is None:
+            return [type_ for type_, args, kwargs in self._types
+                    if type_ not in self._columns]
+        return list(types)
+
+    def snapshot(self, buffer=None, types=None):
+        """Save which entities are used and the state of their components.
+
+        Columns are copied as raw bytes, for all the slots. The other
+        components of the used entities are pickled, so their attributes
+        must be picklable.
+
+        Parameters:
+            buffer (writable buffer or None): Write the snapshot into this
+                buffer, a *bytearray* or a *mmap* for example, instead of
+                allocating a new one.
+            types (iterable of classes or None): Types of the components,
+                not stored in columns, to save. None saves all of them.
+
+        Returns:
+            A *bytearray* with the snapshot, or a *memoryview* of the part
+            of *buffer* that was written.
+
+        Raises:
+            ValueError: If *buffer* is too small.
+        """
+        object_types = self._object_types(types)
+        columns = [column for columns in self._columns.values()
+                   for column in columns.values()]
+        with self._lock:
+            used = list(self._used)
+            slots = array('I', [entity._slot for entity in used])
+            if object_types:
+                states = [[_get_state(entity._components[type_])
+                           for type_ in object_types] for entity in used]
+                objects = pickle.dumps(states, pickle.HIGHEST_PROTOCOL)
+            else:
+                objects = b""
+            typecodes = "".join(map(_typecode, columns)).encode()
+            header = _SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, self._size, len(used), len(columns),
+                len(object_types), len(objects))
+            size = (len(header) + len(typecodes) + len(slots)*slots.itemsize
+                    + sum(len(column)*column.itemsize for column in columns)
+                    + len(objects))
+            if buffer is None:
+                result = view = memoryview(bytearray(size))
+            else:
+                view = memoryview(buffer).cast('B')
+                if len(view) < size:
+                    raise ValueError("The buffer needs {} bytes".format(size))
+                result = view[:size]
+            offset = 0
+            for chunk in [header, typecodes, slots] + columns + [objects]:
+                with memoryview(chunk) as chunk_view:
+                    chunk_view = chunk_view.cast('B')
+                    view[offset:offset + len(chunk_view)] = chunk_view
+                    offset += len(chunk_view)
+        return result.obj if buffer is None else result
+
+    def restore(self, buffer, types=None):
+        """Restore a snapshot made by :func:`snapshot`.
+
+        The used entities become the ones of the snapshot and systems are
+        updated in batch. No init or clean function is called. The pool
+        must have the same types and a capacity at least as large as the
+        pool that made the snapshot.
+
+        Parameters:
+            buffer (buffer): A snapshot. It is read without copying the
+                columns, so a *mmap* can be used directly.
+            types (iterable of classes or None): The same types passed to
+                :func:`snapshot`.
+
+        Raises:
+            ValueError: If the snapshot does not fit this pool.
+        """
+        object_types = self._object_types(types)
+        columns = [column for columns in self._columns.values()
+                   for column in columns.values()]
+        view = memoryview(buffer).cast('B')
+        (magic, size, n_used, n_columns, n_types,
+         objects_size) = _SNAPSHOT_HEADER.unpack_from(view)
+        offset = _SNAPSHOT_HEADER.size
+        typecodes = bytes(view[offset:offset + n_columns]).decode()
+        offset += n_columns
+        if (magic != _SNAPSHOT_MAGIC or n_types != len(object_types)
+            or typecodes != "".join(map(_typecode, columns))):
+            raise ValueError("The snapshot does not match this pool")
+        if size > self._size:
+            raise ValueError("The snapshot needs {} entities".format(size))
+        slots = array('I')
+        slots.frombytes(view[offset:offset + n_used*slots.itemsize])
+        offset += n_used*slots.itemsize
+        with self._lock:
+            if slots and len(self._entities) < size:
+                self._build(max(slots) + 1 - len(self._entities))
+            entities = self._entities
+            used = self._used
+            restored = list(map(entities.__getitem__, slots))
+            restored_used = dict.fromkeys(restored)
+            if used.keys() == restored_used.keys():
+                leaving = joining = ()
+            else:
+                leaving = [entity for entity in used
+                           if entity not in restored_used]
+                joining = [entity for entity in restored if entity not in used]
+                self._bump(leaving)
+                used.clear()
+                used.update(restored_used)
+                avaliable = self._avaliable
+                avaliable.clear()
+                avaliable.extend(entity for entity in reversed(entities)
+                                 if entity not in used)
+            for column in columns:
+                nbytes = size*column.itemsize
+                with memoryview(column) as column_view:
+                    column_view.cast('B')[:nbytes] = view[offset:offset + nbytes]
+                offset += nbytes
+        if objects_size:
+            states = pickle.loads(view[offset:offset + objects_size])
+            for entity, entity_states in zip(restored, states):
+                components = entity._components
+                for type_, state in zip(object_types, entity_states):
+                    _set_state(components[type_], state)
+        self._detach(leaving)
+        self._attach(joining)
+
+    def save(self, path, types=None):
+        """Write a snapshot to the file *path* through a memory map."""
+        size = len(self.snapshot(types=types))
+        with open(path, "w+b") as file_:
+            file_.truncate(size)
+            with mmap.mmap(file_.fileno(), size) as map_:
+                self.snapshot(map_, types)
+
+    def load(self, path, types=None):
+        """Restore a snapshot written by :func:`save`, reading it through a
+        memory map.
+        """
+        with open(path, "rb") as file_:
+            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as map_:
+                self.restore(map_, types)
+
+def _leave_systems(entities):
+    """Remove *entities* from the systems they were added to by hand."""
+    for entity in entities:
+        systems = entity._systems
+        if not systems:
+            continue
+        for system_ref in list(systems):
+            system = system_ref()
+            if system is None:
+                systems.pop(system_ref, None)
+            else:
+                system.remove_entity(entity)
+
+async def _run_hook(hook, entities, batch):
+    """Call *hook* for each entity, gathering *batch* calls at a time if
+    it is a coroutine function.
+    """
+    if hook is None:
+        return
+    if not iscoroutinefunction(hook):
+        for entity in entities:
+            hook(entity)
+        return
+    for i in range(0, len(entities), batch):
+        await asyncio.gather(*[hook(entity) for entity in entities[i:i + batch]])
+
+def _slot_key(entity):
+    return -1 if entity._slot is None else entity._slot
+
+class CommandBuffer(object):
+    """Record structural changes and apply them later, all at once.
+
+    Spawns, frees, components added or deleted and system membership
+    changes are recorded from any thread and applied when you call
+    :func:`flush`. The changes are applied in batches and in a fixed
+    order:
+
+    1. Components deleted, then components added, in recorded order.
+    2. Entities removed from systems, then entities added to systems.
+    3. Frees, one :func:`Pool.free_many` per pool.
+    4. Spawns, one :func:`Pool.get_many` per pool.
+
+    Entities of a pool are applied sorted by their slot, so the same
+    commands leave the same state whatever the order they were recorded
+    from several threads. A :class:`World` has one buffer, see
+    :attr:`World.commands`, flushed at the end of each call.
+
+    Example:
+        .. code-block:: python
+
+            commands = toyblock.CommandBuffer()
+
+            @toyblock.System
+            def shoot(system, entity):
+                if entity[Gun].fire():
+                    commands.spawn(bullets, lambda bullet: aim(bullet, entity))
+
+            @toyblock.System
+            def life(system, entity):
+                if entity[Life].is_over():
+                    commands.free(entity)
+
+            shoot()
+            life()
+            commands.flush()
+    """
+
+    _DEL_COMPONENT = 0
+    _ADD_COMPONENT = 1
+    _REMOVE_ENTITY = 2
+    _ADD_ENTITY = 3
+    _FREE = 4
+    _SPAWN = 5
+
+    def __init__(self):
+        self._lock = Lock()
+        self._commands = []
+
+    def _record(self, command):
+        with self._lock:
+            self._commands.append(command)
+
+    def spawn(self, pool, setup=None):
+        """Get an entity from *pool* when flushing.
+
+        Parameters:
+            pool (Pool)
+            setup (callable, optional): Called with the new entity. It is
+                not called if *pool* has no avaliable entity.
+        """
+        self._record((self._SPAWN, pool, setup))
+
+    def free(self, entity):
+        """Free *entity* when flushing. See :func:`Entity.free`."""
+        self._record((self._FREE, entity, None))
+
+    def add_component(self, entity, instance):
+        """Add *instance* to *entity* when flushing.
+        See :func:`Entity.add_component`.
+
+        Raises:
+            EntityBelongsToPoolError: If *entity* belongs to a Pool.
+        """
+        if entity._pool is not None: raise EntityBelongsToPoolError(entity)
+        self._record((self._ADD_COMPONENT, entity, instance))
+
+    def del_component(self, entity, type_):
+        """Delete the component *type_* of *entity* when flushing.
+        See :func:`Entity.del_component`.
+
+        Raises:
+            EntityBelongsToPoolError: If *entity* belongs to a Pool.
+        """
+        if entity._pool is not None: raise EntityBelongsToPoolError(entity)
+        self._record((self._DEL_COMPONENT, entity, type_))
+
+    def add_entity(self, system, entity):
+        """Add *entity* to *system* when flushing."""
+        self._record((self._ADD_ENTITY, entity, system))
+
+    def remove_entity(self, system, entity):
+        """Remove *entity* from *system* when flushing."""
+        self._record((self._REMOVE_ENTITY, entity, system))
+
+    def flush(self):
+        """Apply the recorded changes.
+
+        Changes recorded while flushing, for example by a setup function,
+        are applied in the next flush. If a change raises an exception the
+        changes not applied yet are kept for the next flush, and the one
+        that raised is dropped.
+
+        Returns:
+            A list with the spawned entities.
+        """
+        with self._lock:
+            commands = self._commands
+            self._commands = []
+        if not commands:
+            return []
+        #  Stable sort, so each kind keeps the recorded order
+        commands.sort(key=lambda command: command[0])
+        applied = 0
+        try:
+            for kind, first, second in commands:
+                if kind > self._ADD_COMPONENT:
+                    break
+                applied += 1
+                if kind == self._DEL_COMPONENT:
+                    first.del_component(second)
+                else:
+                    first.add_component(second)
+        except BaseException:
+            self._keep(commands[applied:])
+            raise
+        groups = {}
+        for command in commands[applied:]:
+            kind, first, second = command
+            if kind == self._SPAWN:
+                key, target = (kind, id(first)), first
+            elif kind == self._FREE:
+                if first._pool is None:
+                    continue
+                key, target = (kind, id(first._pool)), first._pool
+            else:
+                key, target = (kind, id(second)), second
+            if key not in groups:
+                groups[key] = (kind, target, [])
+            groups[key][2].append(command)
+        groups = list(groups.values())
+        spawned = []
+        for i, (kind, target, group) in enumerate(groups):
+            try:
+                if kind == self._SPAWN:
+                    entities = target.get_many(len(group))
+                    spawned.extend(entities)
+                    for entity, command in zip(entities, group):
+                        if command[2] is not None:
+                            command[2](entity)
+                    continue
+                items = sorted([command[1] for command in group], key=_slot_key)
+                if kind == self._REMOVE_ENTITY:
+                    target.remove_entities(items)
+                elif kind == self._ADD_ENTITY:
+                    target.add_entities(items)
+                else:
+                    target.free_many(items)
+            except BaseException:
+                self._keep([command for kind, target, group in groups[i + 1:]
+                            for command in group])
+                raise
+        return spawned
+
+    def _keep(self, commands):
+        """Put back *commands* before the ones recorded meanwhile."""
+        with self._lock:
+            self._commands[:0] = commands
+
+    def __len__(self):
+        return len(self._commands)
+
+class _FixedStep(object):
+    """Accumulator of a system that runs at a fixed rate."""
+
+    __slots__ = ('step', 'max_steps', 'accumulator')
+
+    def __init__(self, rate, max_steps):
+        self.step = 1./rate
+        self.max_steps = max_steps
+        self.accumulator = 0.
+
+    def advance(self, dt):
+        """Add *dt* and return how many steps are due."""
+        step = self.step
+        accumulator = self.accumulator + dt
+        steps = int(accumulator//step)
+        if steps > self.max_steps:
+            #  Too far behind, drop the backlog instead of spiraling
+            steps = self.max_steps
+            accumulator %= step
+        else:
+            accumulator -= steps*step
+        self.accumulator = accumulator
+        return steps
+
+class World(object):
+    """Run systems in stages, in parallel when they do not conflict.
+
+    Each system is registered with the component types it reads and
+    writes. Two systems conflict if one of them writes a type that the
+    other reads or writes. A system is placed in the stage after the last
+    stage holding a system it conflicts with, so conflicting systems keep
+    their registration order while independent systems share a stage.
+
+    The systems of a stage with more than one system run on a thread pool.
+    Entities added to or removed from a running system are applied when it
+    ends, so you can free entities from any stage. Use :attr:`commands`
+    to defer structural changes until all the stages are done.
+
+    Systems registered with a *rate* run at a fixed step instead of once
+    per call: the first argument of the call is the elapsed time in
+    seconds, it is accumulated and the system runs as many times as steps
+    are due, with the step as its first argument. Use :func:`alpha` to
+    interpolate between the last two steps.
+
+    Parameters:
+        workers (int or None): Maximum number of threads. None lets
+            :class:`concurrent.futures.ThreadPoolExecutor` decide. With 1
+            every stage runs in the calling thread.
+        budget (float or None): Milliseconds per call. When a stage starts
+            after the budget is spent, its systems with a negative
+            *priority* are skipped. See :attr:`skipped`.
+
+    Example:
+        .. code-block:: python
+
+            world = toyblock.World()
+            world.add_system(physics, reads=(Body,), writes=(Body,))
+            world.add_system(ai, reads=(Body,), writes=(Brain,))
+            world.add_system(audio, reads=(Sound,), writes=(Sound,))
+            world.add_system(draw, reads=(Body, Graphic), args=(canvas,))
+
+            while playing:
+                world(dt)  # physics(dt) and audio(dt) together, then
+                           # ai(dt) and draw(dt, canvas) together, because
+                           # ai and draw read Body, which physics writes
+
+            @toyblock.System
+            def draw(system, entity, dt):
+                alpha = world.alpha(physics)
+                x = entity[Body].prev_x*(1. - alpha) + entity[Body].x*alpha
+
+            world = toyblock.World(budget=16.)
+            world.add_system(physics, writes=(Body,), rate=120)
+            world.add_system(ai, reads=(Body,), writes=(Brain,), rate=10)
+            world.add_system(particles, writes=(Particle,), priority=-1)
+            world.add_system(draw, reads=(Body,))
+    """
+    def __init__(self, workers=None, budget=None):
+        self._workers = workers
+        self._budget = budget
+        self._skipped = ()
+        self._executor = None
+        self._entries = []
+        self._stages = None
+        self._commands = CommandBuffer()
+
+    @property
+    def commands(self):
+        """The :class:`CommandBuffer` flushed at the end of each call.
+        Read only.
+        """
+        return self._commands
+
+    @property
+    def stages(self):
+        """Tuple of stages. Each stage is a tuple of systems. Read only."""
+        return tuple(tuple(entry[0] for entry in stage)
+                     for stage in self._get_stages())
+
+    def add_system(self, system, reads=(), writes=(), args=(), kwargs=None,
+                   rate=None, max_steps=5, priority=0):
+        """Register *system* in this world.
+
+        Parameters:
+            system (System)
+            reads (iterable of classes): Component types read by *system*.
+            writes (iterable of classes): Component types written by *system*.
+            args (tuple): Extra args passed after the args of the world call.
+            kwargs (dict): Extra kwargs passed to the system.
+            rate (float or None): Runs per second. None runs *system* once
+                per call.
+            max_steps (int): Maximum runs of a *rate* system per call. If
+                more steps are due they are dropped.
+            priority (int): Systems with a negative priority are skipped
+                when the *budget* of the world is spent.
+
+        Returns:
+            The same system passed as parameter.
+        """
+        if not isinstance(system, System):
+            raise TypeError("Pass a System instance")
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive")
+        timer = None if rate is None else _FixedStep(rate, max_steps)
+        self._entries.append((system, frozenset(reads), frozenset(writes),
+                              tuple(args), kwargs or {}, priority, timer))
+        self._stages = None
+        return system
+
+    def remove_system(self, system):
+        """Unregister *system* from this world."""
+        self._entries = [entry for entry in self._entries
+                         if entry[0] is not system]
+        self._stages = None
+
+    def alpha(self, system):
+        """Return how far, from 0 to 1, the time is between the last run
+        of the *rate* system *system* and its next run.
+
+        Raises:
+            ValueError: If *system* is not registered with a *rate*.
+        """
+        for entry in self._entries:
+            if entry[0] is system and entry[6] is not None:
+                timer = entry[6]
+                return timer.accumulator/timer.step
+        raise ValueError("{} has not a rate in this world".format(system))
+
+    @property
+    def skipped(self):
+        """Tuple of the systems skipped by the budget in the last call.
+        Read only.
+        """
+        return self._skipped
+
+    def _get_stages(self):
+        if self._stages is not None:
+            return self._stages
+        stages = []
+        for entry in self._entries:
+            system, reads, writes = entry[:3]
+            index = 0
+            for i, stage in enumerate(stages):
+                for other in stage:
+                    if (writes & (other[1] | other[2])
+                        or other[2] & reads):
+                        index = i + 1
+                        break
+            if index == len(stages):
+                stages.append([])
+            stages[index].append(entry)
+        self._stages = stages
+        return stages
+
+    def __call__(self, *args, **kwargs):
+        """Run all the systems, stage by stage.
+
+        Each system is called with *args* followed by its own args, and
+        with *kwargs* updated with its own kwargs. Then :attr:`commands`
+        is flushed.
+        """
+        skipped = []
+        start = perf_counter()
+        for stage in self._get_stages():
+            stage = self._within_budget(stage, start, skipped)
+            if not stage:
+                continue
+            if len(stage) == 1 or self._workers == 1:
+                for entry in stage:
+                    self._run(entry, args, kwargs)
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._workers)
+            futures = [self._executor.submit(self._run, entry, args, kwargs)
+                       for entry in stage]
+            for future in futures:
+                future.result()
+        self._skipped = tuple(skipped)
+        self._commands.flush()
+
+    async def run_async(self, *args, yield_every=64, **kwargs):
+        """Run all the systems, stage by stage, as a coroutine.
+
+        The systems of a stage run concurrently as tasks of the event
+        loop, see :func:`System.run_async`, instead of threads. The rest
+        is the same as :func:`__call__`.
+
+        Example:
+            .. code-block:: python
+
+                async def game_loop():
+                    while playing:
+                        await world.run_async(dt)
+                        await asyncio.sleep(1./60.)
+        """
+        skipped = []
+        start = perf_counter()
+        for stage in self._get_stages():
+            stage = self._within_budget(stage, start, skipped)
+            if not stage:
+                continue
+            await asyncio.gather(*[self._run_async(entry, args, kwargs,
+                                                   yield_every)
+                                   for entry in stage])
+        self._skipped = tuple(skipped)
+        self._commands.flush()
+
+    def _within_budget(self, stage, start, skipped):
+        """Return the entries of *stage* to run when the budget is spent."""
+        budget = self._budget
+        if budget is None or (perf_counter() - start)*1000. <= budget:
+            return stage
+        skipped.extend(entry[0] for entry in stage if entry[5] < 0)
+        return [entry for entry in stage if entry[5] >= 0]
+
+    @staticmethod
+    def _arguments(entry, args, kwargs):
+        """Return the args, kwargs and number of runs of *entry*."""
+        system, reads, writes, system_args, system_kwargs, priority, timer = entry
+        if system_kwargs:
+            kwargs = dict(kwargs, **system_kwargs)
+        if timer is None:
+            return args + system_args, kwargs, 1
+        if not args:
+            raise TypeError("Pass the elapsed time as the first argument")
+        steps = timer.advance(args[0])
+        return (timer.step,) + args[1:] + system_args, kwargs, steps
+
+    @staticmethod
+    def _run(entry, args, kwargs):
+        args, kwargs, steps = World._arguments(entry, args, kwargs)
+        system = entry[0]
+        for i in range(steps):
+            system(*args, **kwargs)
+
+    @staticmethod
+    async def _run_async(entry, args, kwargs, yield_every):
+        args, kwargs, steps = World._arguments(entry, args, kwargs)
+        system = entry[0]
+        for i in range(steps):
+            await system.run_async(*args, yield_every=yield_every, **kwargs)
+
+    def close(self):
+        """Stop the threads of this world, if any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
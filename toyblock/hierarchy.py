@@ -0,0 +1,216 @@
+# Copyright (C) 2017  Oscar Triano 'dotoscat' <dotoscat (at) gmail (dot) com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parent and child relationships between entities."""
+
+__all__ = ["Hierarchy"]
+
+from . import System
+
+class Hierarchy(System):
+    """A tree of entities where only the changed subtrees are updated.
+
+    A hierarchy is a :class:`toyblock.System`. Entities join it with
+    :func:`attach`, or with :func:`toyblock.System.add_entity` as roots.
+    Calling the hierarchy calls *update* for each dirty entity and for
+    all its descendants, parents before children, so a child can compute
+    its world transform from the one of its parent.
+
+    An entity is dirty when it joins the hierarchy, when it is attached
+    or detached, when you call :func:`mark` and when one of its
+    components of the types *changed* is changed, see
+    :func:`toyblock.Entity.touch`.
+
+    When an entity leaves the hierarchy, for example because it is freed,
+    its children are freed if *on_free* is "free" and they belong to a
+    :class:`toyblock.Pool`. Otherwise they are detached and become roots.
+
+    Parameters:
+        update (callable): Signature is
+            update(hierarchy, entity, parent, \\*args, \\*\\*kwargs). *parent*
+            is None for the roots.
+        changed (iterable of classes): Component types which make an
+            entity dirty when they change.
+        on_free (str): "free" or "detach".
+
+    Example:
+        .. code-block:: python
+
+            from toyblock.hierarchy import Hierarchy
+
+            def place(hierarchy, entity, parent):
+                local = entity[Transform]
+                if parent is None:
+                    local.world_x = local.x
+                else:
+                    local.world_x = parent[Transform].world_x + local.x
+
+            scene = Hierarchy(place, changed=(Transform,))
+            scene.attach(turret, tank)
+            tank[Transform].x += 10.  # Transform is Tracked
+            scene()  # updates tank and turret, not the rest of the scene
+    """
+
+    _hooks = True
+
+    def __init__(self, update=None, changed=(), on_free="free"):
+        if on_free not in ("free", "detach"):
+            raise ValueError("on_free must be 'free' or 'detach'")
+        self._update = update
+        self._on_free = on_free
+        self._parent = {}
+        self._children = {}
+        self._depth = {}
+        #  Entities of each depth, the traversal index
+        self._levels = []
+        self._dirty = {}
+        super(Hierarchy, self).__init__(_propagate, batch=True,
+                                        changed=tuple(changed) or None)
+
+    def _node(self, entity):
+        if entity in self._depth:
+            return
+        self._parent[entity] = None
+        self._children[entity] = {}
+        self._set_depth(entity, 0)
+        self._dirty[entity] = None
+
+    def _set_depth(self, entity, depth):
+        levels = self._levels
+        old = self._depth.get(entity)
+        if old is not None:
+            del levels[old][entity]
+            while levels and not levels[-1]:
+                levels.pop()
+        while len(levels) <= depth:
+            levels.append({})
+        levels[depth][entity] = None
+        self._depth[entity] = depth
+
+    def _relevel(self, entity, depth):
+        """Set the depth of *entity* and of its descendants."""
+        stack = [(entity, depth)]
+        while stack:
+            entity, depth = stack.pop()
+            self._set_depth(entity, depth)
+            stack.extend((child, depth + 1) for child in self._children[entity])
+
+    def _entity_added(self, entity):
+        super(Hierarchy, self)._entity_added(entity)
+        self._node(entity)
+
+    def _entity_removed(self, entity):
+        super(Hierarchy, self)._entity_removed(entity)
+        if entity not in self._depth:
+            return
+        parent = self._parent.pop(entity)
+        if parent is not None:
+            self._children[parent].pop(entity, None)
+        children = list(self._children.pop(entity))
+        del self._levels[self._depth.pop(entity)][entity]
+        while self._levels and not self._levels[-1]:
+            self._levels.pop()
+        self._dirty.pop(entity, None)
+        for child in children:
+            self._parent[child] = None
+            self._relevel(child, 0)
+            self._dirty[child] = None
+            if self._on_free == "free" and child.pool is not None:
+                child.free()
+
+    def attach(self, child, parent=None):
+        """Make *child* a child of *parent*, or a root if *parent* is None.
+
+        Both entities join the hierarchy if they are not in it.
+
+        Raises:
+            ValueError: If *parent* is *child* or one of its descendants.
+        """
+        if parent is not None:
+            ancestor = parent
+            while ancestor is not None:
+                if ancestor is child:
+                    raise ValueError("{} can not be its own ancestor".format(child))
+                ancestor = self._parent.get(ancestor)
+            self._node(parent)
+            self.add_entity(parent)
+        self._node(child)
+        self.add_entity(child)
+        old = self._parent[child]
+        if old is not None:
+            del self._children[old][child]
+        self._parent[child] = parent
+        if parent is None:
+            self._relevel(child, 0)
+        else:
+            self._children[parent][child] = None
+            self._relevel(child, self._depth[parent] + 1)
+        self._dirty[child] = None
+
+    def detach(self, child):
+        """Make *child* a root."""
+        if child in self._depth:
+            self.attach(child)
+
+    def mark(self, entity):
+        """Make *entity* dirty, so it and its descendants are updated in
+        the next call.
+        """
+        if entity in self._depth:
+            self._dirty[entity] = None
+
+    def parent(self, entity):
+        """Return the parent of *entity*, or None."""
+        return self._parent.get(entity)
+
+    def children(self, entity):
+        """Return a tuple with the children of *entity*."""
+        return tuple(self._children.get(entity, ()))
+
+    def depth(self, entity):
+        """Return the depth of *entity*, 0 for the roots."""
+        return self._depth[entity]
+
+    def walk(self):
+        """Yield all the entities, parents before their children."""
+        for level in list(self._levels):
+            for entity in list(level):
+                yield entity
+
+def _propagate(hierarchy, changed, *args, **kwargs):
+    dirty = hierarchy._dirty
+    hierarchy._dirty = {}
+    if hierarchy._watches:
+        dirty.update(dict.fromkeys(changed))
+    update = hierarchy._update
+    if update is None or not dirty:
+        return
+    depth = hierarchy._depth
+    children = hierarchy._children
+    parent = hierarchy._parent
+    #  Dirty entities and their subtrees, grouped by depth
+    levels = {}
+    seen = set()
+    stack = list(dirty)
+    while stack:
+        entity = stack.pop()
+        if entity in seen or entity not in depth:
+            continue
+        seen.add(entity)
+        levels.setdefault(depth[entity], []).append(entity)
+        stack.extend(children[entity])
+    for level in sorted(levels):
+        for entity in levels[level]:
+            update(hierarchy, entity, parent[entity], *args, **kwargs)
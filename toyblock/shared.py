@@ -0,0 +1,226 @@
+# Copyright (C) 2017  Oscar Triano 'dotoscat' <dotoscat (at) gmail (dot) com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar pools in shared memory and systems sharded over processes."""
+
+__all__ = ["SharedPool", "ShardedSystem", "Shard"]
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+from . import Pool, _column_view
+
+def _column_key(type_, name):
+    return "{}.{}.{}".format(type_.__module__, type_.__qualname__, name)
+
+class SharedPool(Pool):
+    """A columnar :class:`toyblock.Pool` whose columns live in
+    :mod:`multiprocessing.shared_memory`.
+
+    The columns are memoryviews instead of arrays, so worker processes
+    can read and write them without copying. See :class:`ShardedSystem`.
+    A shared pool can not grow nor be lazy. Call :func:`close` when you
+    are done with it.
+
+    Parameters:
+        maxlen (int): Number of entities.
+        types (iterable of classes): As in :class:`toyblock.Pool`.
+        args_list (iterable of tuples): As in :class:`toyblock.Pool`.
+        kwargs_list (iterable of dicts): As in :class:`toyblock.Pool`.
+        systems (iterable of System): As in :class:`toyblock.Pool`.
+    """
+
+    def __init__(self, maxlen, types, args_list=(), kwargs_list=(),
+                 systems=None):
+        super(SharedPool, self).__init__(maxlen, types, args_list, kwargs_list,
+                                         systems, columnar=True)
+        self._memory = []
+        self._layout = []
+        for type_, columns in self._columns.items():
+            for name, column in columns.items():
+                nbytes = len(column)*column.itemsize
+                memory = SharedMemory(create=True, size=max(nbytes, 1))
+                shared = memory.buf[:nbytes].cast(column.typecode)
+                with memoryview(column) as source:
+                    shared[:] = source
+                columns[name] = shared
+                self._memory.append((memory, shared))
+                self._layout.append((_column_key(type_, name), memory.name,
+                                     column.typecode, nbytes))
+            view = self._views[type_] = _column_view(type_, columns,
+                                                     self._entities)
+            for entity in self._entities:
+                entity._components[type_] = view(entity._slot)
+
+    def close(self):
+        """Release and unlink the shared memory. The columns can not be
+        used anymore.
+        """
+        for memory, shared in self._memory:
+            shared.release()
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Shard(object):
+    """The part of a :class:`SharedPool` given to a kernel of a
+    :class:`ShardedSystem`.
+
+    Attributes:
+        slots (array): Slots of the used entities of this shard.
+    """
+
+    def __init__(self, columns, slots):
+        self._columns = columns
+        self.slots = slots
+        self._frees = []
+        self._spawns = []
+
+    def column(self, type_, name):
+        """Return the shared column *name* of *type_*."""
+        return self._columns[_column_key(type_, name)]
+
+    def free(self, slot):
+        """Free the entity of *slot* after all the shards are done."""
+        self._frees.append(slot)
+
+    def spawn(self, *args):
+        """Get a new entity after all the shards are done. *args* are
+        passed to the *spawn* function of the :class:`ShardedSystem`.
+        """
+        self._spawns.append(args)
+
+#  Columns attached by each worker process
+_worker_columns = {}
+_worker_memory = []
+
+def _attach(layout):
+    for key, memory_name, typecode, nbytes in layout:
+        memory = SharedMemory(name=memory_name)
+        _worker_memory.append(memory)
+        _worker_columns[key] = memory.buf[:nbytes].cast(typecode)
+
+def _run_shard(kernel, slots, args):
+    shard = Shard(_worker_columns, slots)
+    kernel(shard, *args)
+    return shard._frees, shard._spawns
+
+class ShardedSystem(object):
+    """Run a kernel over the used entities of a :class:`SharedPool`,
+    split in shards, one per worker process.
+
+    The kernel is called in each worker as ``kernel(shard, *args)`` and
+    works on the columns with the slots of its :class:`Shard`. It must be
+    a module level function, so it can be sent to the workers. Only the
+    slots and the arguments are sent, the columns are shared.
+
+    Calling the system waits until every shard is done. Then the frees
+    and spawns requested by the shards are applied in the parent process,
+    in shard order: the frees with one :func:`toyblock.Pool.free_many`
+    and the spawns with one :func:`toyblock.Pool.get_many`.
+
+    Parameters:
+        pool (SharedPool)
+        kernel (callable): Signature is kernel(shard, \\*args)
+        processes (int or None): Number of worker processes. None uses
+            the number of CPUs. With 1 the kernel runs in this process.
+        spawn (callable, optional): Signature is spawn(entity, \\*args),
+            called for each spawned entity with the args given to
+            :func:`Shard.spawn`.
+
+    Example:
+        .. code-block:: python
+
+            from toyblock.shared import SharedPool, ShardedSystem
+
+            def move(shard, dt):
+                xs = shard.column(Body, 'x')
+                vel_xs = shard.column(Body, 'vel_x')
+                for i in shard.slots:
+                    xs[i] += vel_xs[i]*dt
+                    if xs[i] > 1000.:
+                        shard.free(i)
+
+            with SharedPool(100000, (Body,)) as npcs:
+                physics = ShardedSystem(npcs, move, processes=16)
+                while playing:
+                    physics(dt)
+                physics.close()
+    """
+
+    def __init__(self, pool, kernel, processes=None, spawn=None):
+        if not isinstance(pool, SharedPool):
+            raise TypeError("Pass a SharedPool")
+        self._pool = pool
+        self._kernel = kernel
+        self._processes = processes or os.cpu_count() or 1
+        self._spawn = spawn
+        self._executor = None
+
+    def _shards(self):
+        slots = sorted(entity._slot for entity in self._pool._used)
+        size = -(-len(slots)//self._processes) or 1
+        return [array('l', slots[i:i + size])
+                for i in range(0, len(slots), size)]
+
+    def __call__(self, *args):
+        """Run the kernel over all the shards and merge the results."""
+        shards = self._shards()
+        if self._processes == 1:
+            columns = {_column_key(type_, name): column
+                       for type_, columns in self._pool._columns.items()
+                       for name, column in columns.items()}
+            results = []
+            for slots in shards:
+                shard = Shard(columns, slots)
+                self._kernel(shard, *args)
+                results.append((shard._frees, shard._spawns))
+        else:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self._processes, initializer=_attach,
+                    initargs=(self._pool._layout,))
+            futures = [self._executor.submit(_run_shard, self._kernel, slots,
+                                             args)
+                       for slots in shards]
+            results = [future.result() for future in futures]
+        self._merge(results)
+
+    def _merge(self, results):
+        pool = self._pool
+        entities = pool._entities
+        frees = [entities[slot] for frees, spawns in results for slot in frees]
+        spawns = [args for frees, spawns in results for args in spawns]
+        if frees:
+            pool.free_many(frees)
+        if spawns:
+            spawned = pool.get_many(len(spawns))
+            if self._spawn is not None:
+                for entity, args in zip(spawned, spawns):
+                    self._spawn(entity, *args)
+
+    def close(self):
+        """Stop the worker processes, if any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,264 @@
+# Copyright (C) 2017  Oscar Triano 'dotoscat' <dotoscat (at) gmail (dot) com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spatial indexing of entities for collision queries."""
+
+__all__ = ["SpatialGrid"]
+
+from math import floor, hypot
+
+from . import System, Tracked
+
+class SpatialGrid(System):
+    """A uniform grid of entities bucketed by the position of a component.
+
+    A grid is a :class:`toyblock.System` that requires *type_*, so any
+    entity with that component joins the grid and leaves it when it is
+    freed or loses the component. Calling the grid moves the entities
+    whose position moved to another cell. Use :func:`move` to update a
+    single entity between calls.
+
+    If *type_* is a :class:`toyblock.Tracked` component a call only
+    visits the entities whose component changed since the previous call,
+    see :func:`toyblock.Entity.touch`. Otherwise every entity of the grid
+    is checked on each call.
+
+    Parameters:
+        cell_size (float): Side of each cell.
+        type\\_ (class): Component type with the position.
+        x (str): Name of the x attribute of *type_*.
+        y (str): Name of the y attribute of *type_*.
+        requires (iterable of classes): Other component types required.
+        excludes (iterable of classes): Component types excluded.
+
+    Choose a *cell_size* at least as large as the biggest collision
+    diameter, then two entities can only collide if they are in the same
+    or in adjacent cells and :func:`pairs` returns every candidate.
+
+    Example:
+        .. code-block:: python
+
+            from toyblock.spatial import SpatialGrid
+
+            bullets_grid = SpatialGrid(32., Body, requires=(Bullet,))
+            enemies_grid = SpatialGrid(32., Body, requires=(Enemy,))
+            # ...
+            while playing:
+                physics(dt)
+                bullets_grid()
+                for bullet, enemy in bullets_grid.pairs_with(enemies_grid):
+                    if bullet[Collision].collides_with(enemy[Collision]):
+                        bullet.free()
+    """
+
+    _hooks = True
+
+    def __init__(self, cell_size, type_, x="x", y="y", requires=(),
+                 excludes=()):
+        self._cell_size = cell_size
+        self._type = type_
+        self._x = x
+        self._y = y
+        self._cells = {}
+        self._cell_of = {}
+        changed = (type_,) if issubclass(type_, Tracked) else None
+        super(SpatialGrid, self).__init__(
+            _update, requires=(type_,) + tuple(requires), excludes=excludes,
+            batch=True, changed=changed)
+
+    @property
+    def cell_size(self):
+        """Side of each cell. Read only."""
+        return self._cell_size
+
+    def _position(self, entity):
+        component = entity[self._type]
+        return getattr(component, self._x), getattr(component, self._y)
+
+    def _cell(self, x, y):
+        size = self._cell_size
+        return floor(x/size), floor(y/size)
+
+    def _entity_added(self, entity):
+        #  Not marked as changed, it is put in its cell right now
+        self._bucket_add(entity)
+
+    def _entity_removed(self, entity):
+        super(SpatialGrid, self)._entity_removed(entity)
+        self._bucket_remove(entity)
+
+    def _bucket_add(self, entity):
+        cell = self._cell(*self._position(entity))
+        self._cell_of[entity] = cell
+        bucket = self._cells.get(cell)
+        if bucket is None:
+            bucket = self._cells[cell] = {}
+        bucket[entity] = None
+
+    def _bucket_remove(self, entity):
+        cell = self._cell_of.pop(entity)
+        bucket = self._cells[cell]
+        del bucket[entity]
+        if not bucket:
+            del self._cells[cell]
+
+    def move(self, entity):
+        """Put *entity* in the cell of its current position."""
+        old = self._cell_of.get(entity)
+        if old is None:
+            return
+        cell = self._cell(*self._position(entity))
+        if cell == old:
+            return
+        self._bucket_remove(entity)
+        self._bucket_add(entity)
+
+    def query_range(self, x0, y0, x1, y1):
+        """Return the entities whose position is inside the rectangle.
+
+        Only the cells that overlap the rectangle are visited.
+        """
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        cells = self._cells
+        position = self._position
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is None:
+                    continue
+                for entity in bucket:
+                    x, y = position(entity)
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        found.append(entity)
+        return found
+
+    def query_radius(self, x, y, radius):
+        """Return the entities whose position is at *radius* or less."""
+        position = self._position
+        return [entity for entity in
+                self.query_range(x - radius, y - radius, x + radius, y + radius)
+                if hypot(position(entity)[0] - x, position(entity)[1] - y)
+                <= radius]
+
+    def nearest(self, x, y, max_distance=None):
+        """Return the nearest entity to the point, or None.
+
+        The search visits rings of cells around the point and stops when
+        the next ring can not hold anything nearer.
+        """
+        if not self._cell_of:
+            return None
+        cells = self._cells
+        position = self._position
+        size = self._cell_size
+        cx, cy = self._cell(x, y)
+        if max_distance is None:
+            xs = [cell[0] for cell in cells]
+            ys = [cell[1] for cell in cells]
+            rings = max(abs(cx - min(xs)), abs(cx - max(xs)),
+                        abs(cy - min(ys)), abs(cy - max(ys)))
+        else:
+            rings = int(max_distance//size) + 1
+        best = None
+        best_distance = max_distance
+        for ring in range(rings + 1):
+            #  Any entity of this ring is at least this far
+            if best is not None and (ring - 1)*size > best_distance:
+                break
+            for cell in _ring(cx, cy, ring):
+                bucket = cells.get(cell)
+                if bucket is None:
+                    continue
+                for entity in bucket:
+                    ex, ey = position(entity)
+                    distance = hypot(ex - x, ey - y)
+                    if best_distance is None or distance < best_distance:
+                        best = entity
+                        best_distance = distance
+        return best
+
+    def pairs(self):
+        """Yield each pair of entities in the same or in adjacent cells once.
+
+        This is a broadphase: test the pairs with your own collision code.
+        It is safe to free entities while iterating, freed entities are
+        not yielded anymore.
+        """
+        cells = self._cells
+        alive = self._cell_of
+        for (cx, cy), bucket in list(cells.items()):
+            entities = list(bucket)
+            for i, entity in enumerate(entities):
+                for other in entities[i + 1:]:
+                    if entity in alive and other in alive:
+                        yield entity, other
+            #  Half of the neighbours, so every pair is visited once
+            for neighbour in ((cx + 1, cy - 1), (cx + 1, cy),
+                              (cx + 1, cy + 1), (cx, cy + 1)):
+                others = cells.get(neighbour)
+                if others is None:
+                    continue
+                for entity in entities:
+                    for other in list(others):
+                        if entity in alive and other in alive:
+                            yield entity, other
+
+    def pairs_with(self, grid):
+        """Yield *(entity, other)* for each entity of this grid and each
+        entity of *grid* in the same or in an adjacent cell.
+
+        Both grids must have the same *cell_size*. It is safe to free
+        entities while iterating.
+        """
+        if grid._cell_size != self._cell_size:
+            raise ValueError("Both grids must have the same cell size")
+        others = grid._cells
+        alive = self._cell_of
+        other_alive = grid._cell_of
+        for (cx, cy), bucket in list(self._cells.items()):
+            entities = list(bucket)
+            for nx in (cx - 1, cx, cx + 1):
+                for ny in (cy - 1, cy, cy + 1):
+                    other_bucket = others.get((nx, ny))
+                    if other_bucket is None:
+                        continue
+                    for other in list(other_bucket):
+                        for entity in entities:
+                            if (entity is not other and entity in alive
+                                and other in other_alive):
+                                yield entity, other
+
+def _update(grid, entities):
+    cell_of = grid._cell_of
+    cell = grid._cell
+    position = grid._position
+    for entity in entities:
+        if cell(*position(entity)) != cell_of[entity]:
+            grid._bucket_remove(entity)
+            grid._bucket_add(entity)
+
+def _ring(cx, cy, ring):
+    """Yield the cells at Chebyshev distance *ring* from *(cx, cy)*."""
+    if ring == 0:
+        yield cx, cy
+        return
+    for x in range(cx - ring, cx + ring + 1):
+        yield x, cy - ring
+        yield x, cy + ring
+    for y in range(cy - ring + 1, cy + ring):
+        yield cx - ring, y
+        yield cx + ring, y